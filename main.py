@@ -1,25 +1,42 @@
 import os
-import requests
 import uuid
 import re
 import tempfile
 import json
+import copy
+import hashlib
+import struct
+import mmap
+import sys
+import base64
 import asyncio
+import random
+import socket
+import time
+import contextvars
+from abc import ABC, abstractmethod
 from enum import Enum
 from pathlib import Path
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit, urlunsplit, quote
 from datetime import datetime, timedelta
-import assemblyai as aai
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, Response
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from twilio.rest import Client
-from twilio.twiml.voice_response import VoiceResponse, Record, Play, Say
+from twilio.twiml.voice_response import VoiceResponse, Record, Play, Say, Connect, Gather
 import httpx
-import redis
+import msgpack
+import numpy as np
+import redis.asyncio as aioredis
+from websockets.asyncio.client import connect as ws_connect
+
+try:
+    import audioop  # stdlib up to 3.12, audioop-lts on 3.13+
+except ImportError:
+    audioop = None
 
 load_dotenv()
 
@@ -32,79 +49,581 @@ TWILIO_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_PHONE = os.getenv("TWILIO_PHONE_NUMBER")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "http://localhost:8000")
 
-# Setup AssemblyAI
-aai.settings.api_key = ASSEMBLYAI_API_KEY
-
 # Audio temp directory
 TEMP_AUDIO_DIR = Path(tempfile.gettempdir()) / "riya_audio"
 TEMP_AUDIO_DIR.mkdir(exist_ok=True)
 
+# TTS voice settings (part of the cache key - changing any of these re-renders prompts)
+TTS_VOICE_ID = int(os.getenv("TTS_VOICE_ID", "147320"))
+TTS_SPEECH_MODEL = os.getenv("TTS_SPEECH_MODEL", "mars-flash")
+TTS_LANGUAGE = os.getenv("TTS_LANGUAGE", "en-us")
+
+# Content-addressed TTS cache, shared by every call (set TTS_CACHE=0 to disable)
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE", "1") != "0"
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", str(TEMP_AUDIO_DIR / "tts_cache")))
+TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# CambAI connection pool (keep-alive connections are reused across webhooks)
+CAMB_TTS_URL = "https://client.camb.ai/apis/tts-stream"
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "60"))
+TTS_MAX_CONNECTIONS = int(os.getenv("TTS_MAX_CONNECTIONS", "20"))
+
+# Return the <Play> URL immediately and stream CambAI audio through /audio (TTS_STREAMING=1)
+TTS_STREAMING = os.getenv("TTS_STREAMING", "0") == "1"
+
+# Replies longer than this many words are synthesized sentence by sentence (0 disables)
+TTS_CHUNK_MIN_WORDS = int(os.getenv("TTS_CHUNK_MIN_WORDS", "25"))
+
+# TTS routing: hedge a slow request, and fall back to <Say> once the budget is spent
+# (Twilio gives up on a webhook after 15 s, so the budget must leave room for STT)
+TTS_LATENCY_BUDGET = float(os.getenv("TTS_LATENCY_BUDGET_SECONDS", "6"))
+TTS_HEDGE_AFTER = float(os.getenv("TTS_HEDGE_AFTER_SECONDS", "0"))  # 0 = derive from EWMA latency
+TTS_EWMA_ALPHA = float(os.getenv("TTS_EWMA_ALPHA", "0.2"))
+TTS_MAX_ERROR_RATE = float(os.getenv("TTS_MAX_ERROR_RATE", "0.5"))
+TTS_PROBE_INTERVAL = float(os.getenv("TTS_PROBE_INTERVAL_SECONDS", "10"))
+
+# Redis connection pool per process (sessions, timelines and cross-worker locks share it)
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "50"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT_SECONDS", "5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT_SECONDS", "2"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL_SECONDS", "30"))
+
+# Coalesce identical TTS/STT work across workers through Redis locks (in-process coalescing is always on;
+# TTS only coalesces across workers with AUDIO_STORE=redis, where every worker can read the result)
+SINGLE_FLIGHT_REDIS = os.getenv("SINGLE_FLIGHT_REDIS", "0") == "1"
+
+# How long a webhook turn's TwiML is kept to answer Twilio retries of the same turn
+WEBHOOK_REPLAY_TTL = int(os.getenv("WEBHOOK_REPLAY_TTL_SECONDS", "600"))
+
+# Stored/served prompt format: "ulaw" = 8 kHz mono mu-law (what the PSTN leg carries), "wav" = as CambAI sends it
+AUDIO_FORMATS = {
+    "ulaw": (".ulaw", "audio/ulaw"),
+    "wav": (".wav", "audio/wav"),
+}
+TTS_AUDIO_FORMAT = os.getenv("TTS_AUDIO_FORMAT", "ulaw")
+if TTS_AUDIO_FORMAT not in AUDIO_FORMATS or (TTS_AUDIO_FORMAT == "ulaw" and audioop is None):
+    print(f"⚠️  TTS_AUDIO_FORMAT={TTS_AUDIO_FORMAT} unavailable, serving CambAI WAV as-is")
+    TTS_AUDIO_FORMAT = "wav"
+
+# Eviction for per-call audio in TEMP_AUDIO_DIR (cached prompts in TTS_CACHE_DIR are never evicted)
+AUDIO_MAX_AGE = int(os.getenv("AUDIO_MAX_AGE_SECONDS", "3600"))
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", str(200 * 1024 * 1024)))
+AUDIO_GC_INTERVAL = int(os.getenv("AUDIO_GC_INTERVAL_SECONDS", "300"))
+
+# Pre-synthesize the replies reachable from the current state while the candidate is answering
+SPECULATION_ENABLED = os.getenv("TTS_SPECULATION", "1") != "0"
+SPECULATION_MAX_PROMPTS = int(os.getenv("SPECULATION_MAX_PROMPTS_PER_TURN", "4"))
+SPECULATION_CONCURRENCY = int(os.getenv("SPECULATION_CONCURRENCY_PER_CALL", "2"))
+
+# Pre-rendered prompt audio shipped with the deploy (built by `python main.py build-prompt-pack`)
+PROMPT_PACK_PATH = Path(os.getenv("PROMPT_PACK_PATH", str(Path(__file__).parent / "prompts.pack")))
+
+# Where audio lives: "local" disk of this instance, or "redis" so any instance can serve /audio
+AUDIO_STORE = os.getenv("AUDIO_STORE", "local")
+AUDIO_STORE_REDIS_URL = os.getenv("AUDIO_STORE_REDIS_URL") or os.getenv("REDIS_URL")
+SHARED_AUDIO_STORE = AUDIO_STORE == "redis" and bool(AUDIO_STORE_REDIS_URL)
+
+# How recordings reach AssemblyAI: "url" lets AssemblyAI fetch RecordingUrl itself,
+# "stream" relays the Twilio download into the upload, "download" buffers it in memory first
+STT_INPUT_MODE = os.getenv("STT_INPUT_MODE", "stream")
+ASSEMBLYAI_API_URL = "https://api.assemblyai.com/v2"
+
+# Async transcription: jobs are submitted, then completed by /stt-callback (STT_CALLBACK=1)
+# or by polling with backoff; at most STT_MAX_CONCURRENCY run at once per process
+STT_MAX_CONCURRENCY = int(os.getenv("STT_MAX_CONCURRENCY", "10"))
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT_SECONDS", "60"))
+STT_CALLBACK = os.getenv("STT_CALLBACK", "0") == "1"
+STT_CALLBACK_SECRET = os.getenv("STT_CALLBACK_SECRET") or hashlib.sha256(f"stt:{ASSEMBLYAI_API_KEY}".encode()).hexdigest()
+# A callback that reaches a worker without the waiting turn is relayed to the others over Redis pub/sub
+STT_CALLBACK_CHANNEL = "riya:stt-callbacks"
+
+# Voice activity check before STT: recordings shorter than VAD_MIN_DURATION (Twilio's RecordingDuration)
+# or with under VAD_MIN_SPEECH_MS of 20 ms frames louder than VAD_THRESHOLD_DBFS are treated as silence
+VAD_ENABLED = os.getenv("VAD_ENABLED", "1") == "1"
+VAD_MIN_DURATION = float(os.getenv("VAD_MIN_DURATION_SECONDS", "1"))
+VAD_THRESHOLD_DBFS = float(os.getenv("VAD_THRESHOLD_DBFS", "-40"))
+VAD_MIN_SPEECH_MS = int(os.getenv("VAD_MIN_SPEECH_MS", "200"))
+
+# How the caller's speech reaches us: "record" = <Record> + batch STT per turn,
+# "stream" = Twilio Media Streams into a streaming recognizer, replies sent back over the same socket
+CALL_AUDIO_MODE = os.getenv("CALL_AUDIO_MODE", "record")
+STREAMING_STT_PROVIDER = os.getenv("STREAMING_STT_PROVIDER", "assemblyai")  # or "fake" for local testing
+FAKE_STT_SCRIPT = [line for line in os.getenv("FAKE_STT_SCRIPT", "").split("|") if line]
+
+# In "record" mode, short yes/no style answers go through Twilio's own speech recognition
+# (<Gather input="speech">) instead of <Record> + batch STT; see STATE_INPUT_MODES
+SPEECH_GATHER = os.getenv("SPEECH_GATHER", "1") == "1"
+GATHER_LANGUAGE = os.getenv("GATHER_LANGUAGE", "en-IN")
+GATHER_TIMEOUT = int(os.getenv("GATHER_TIMEOUT_SECONDS", "5"))
+
+# Set when the Twilio account enforces HTTP auth on recording media. Prefer an API key
+# (TWILIO_API_KEY/TWILIO_API_SECRET): in "url" mode the credentials are handed to AssemblyAI.
+TWILIO_MEDIA_AUTH = os.getenv("TWILIO_MEDIA_AUTH", "0") == "1"
+TWILIO_API_KEY = os.getenv("TWILIO_API_KEY")
+TWILIO_API_SECRET = os.getenv("TWILIO_API_SECRET")
+
 # Twilio client
 twilio_client = Client(TWILIO_SID, TWILIO_TOKEN) if TWILIO_SID and TWILIO_TOKEN else None
 
+# ================= METRICS =================
+
+# Bucket upper bounds (seconds) shared by the latency histograms
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# ConversationState value of the turn being handled, so deep stages (download, STT, Redis) can label by it
+metrics_state = contextvars.ContextVar("metrics_state", default="none")
+
+# Timeline events of the turn being handled; stage timers append to it and the turn flushes it
+# to the session's timeline in one write
+turn_trace = contextvars.ContextVar("turn_trace", default=None)
+
+# Monotonic clocks are only comparable within one process, so every event names its worker
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def trace_event(event: str, **fields) -> dict:
+    return {"event": event, "at": time.time(), "mono": round(time.monotonic(), 6), "worker": WORKER_ID, **fields}
+
+def metric_labels(names, values) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+class Histogram:
+    """Prometheus histogram over LATENCY_BUCKETS, one series per combination of label values."""
+    
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.series = {}  # label values -> [cumulative bucket counts..., count, sum]
+    
+    def observe(self, value: float, *label_values):
+        row = self.series.setdefault(label_values, [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += 1
+        row[-1] += value
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, row in self.series.items():
+            labels = metric_labels(self.labels, label_values)
+            for bound, count in zip(LATENCY_BUCKETS, row):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {row[-2]}')
+            lines.append(f"{self.name}_count{{{labels}}} {row[-2]}")
+            lines.append(f"{self.name}_sum{{{labels}}} {row[-1]:.6f}")
+        return lines
+
+class Counter:
+    """Prometheus counter, one series per combination of label values."""
+    
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.series = {}
+    
+    def inc(self, *label_values):
+        self.series[label_values] = self.series.get(label_values, 0) + 1
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, count in self.series.items():
+            lines.append(f"{self.name}{{{metric_labels(self.labels, label_values)}}} {count}")
+        return lines
+
+class Timer:
+    """Times a block into a histogram labelled (*labels, state, outcome). The outcome is "ok", or "error"
+    if the block raised; set timer.outcome inside the block to report something more specific.
+    The state is the turn's metrics_state unless the block sets timer.state.
+    Stage timers also add an event named after the stage to the current turn's trace."""
+    
+    def __init__(self, histogram: Histogram, *labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.outcome = None
+        self.state = None
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        outcome = self.outcome or ("error" if exc_type else "ok")
+        self.histogram.observe(elapsed, *self.labels, self.state or metrics_state.get(), outcome)
+        trace = turn_trace.get()
+        if trace is not None and self.labels:
+            trace.append(trace_event(self.labels[0], seconds=round(elapsed, 4), outcome=outcome))
+        return False
+
+stage_seconds = Histogram(
+    "riya_turn_stage_seconds",
+    "Time spent in each stage of a webhook turn",
+    ("stage", "state", "outcome")
+)
+turn_seconds = Histogram("riya_webhook_turn_seconds", "Total time to answer a webhook turn", ("state", "outcome"))
+tts_fallbacks = Counter("riya_tts_fallbacks_total", "Turns answered with <Say> because TTS failed", ("state",))
+stt_errors = Counter("riya_stt_errors_total", "Failed transcriptions by reason", ("state", "reason"))
+
+def stats_metrics(prefix: str, stats: dict) -> list:
+    """Expose one of the /health stats dicts as untyped samples, flattening nested dicts."""
+    lines = []
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            lines.extend(stats_metrics(name, value))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{name} {value}")
+    return lines
+
 # ================= REDIS & SESSION MANAGEMENT =================
 
+def bounded_redis_pool(url: str) -> aioredis.BlockingConnectionPool:
+    """Pool capped at REDIS_POOL_SIZE with socket timeouts, so a hung Redis fails requests
+    instead of stalling them."""
+    return aioredis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=REDIS_POOL_SIZE,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL
+    )  # raw bytes: sessions and audio are binary
+
+# One async client shared by sessions, timelines, cross-worker coordination and, on the same URL,
+# the Redis audio store. The blocking pool caps connections per process: a burst of calls waits up
+# to REDIS_POOL_TIMEOUT for a free connection instead of opening one per request or blocking the event loop.
+redis_url = os.getenv("REDIS_URL")
+redis_pool = None
 redis_client = None
-try:
-    redis_url = os.getenv("REDIS_URL")
-    if redis_url:
-        redis_client = redis.Redis.from_url(redis_url, decode_responses=True)
-        redis_client.ping()
-        print("✅ Redis connected")
-    else:
-        print("⚠️  No REDIS_URL found, using in-memory sessions (will break on Render restart)")
-except Exception as e:
-    print(f"❌ Redis connection failed: {e}")
-    redis_client = None
+if redis_url:
+    redis_pool = bounded_redis_pool(redis_url)
+    redis_client = aioredis.Redis(connection_pool=redis_pool)
+else:
+    print("⚠️  No REDIS_URL found, using in-memory sessions (will break on Render restart)")
+
+def redis_pool_stats() -> dict:
+    """Connections of this process's Redis pool: in use, idle (created and free) and the cap."""
+    if redis_pool is None:
+        return {}
+    in_use = len(getattr(redis_pool, "_in_use_connections", ()))
+    idle = len([c for c in getattr(redis_pool, "_available_connections", ()) if c is not None])
+    return {
+        "max_connections": redis_pool.max_connections,
+        "in_use": in_use,
+        "idle": idle,
+        "utilization": round(in_use / redis_pool.max_connections, 3)
+    }
+
+# Sessions are two Redis hashes. The session hash holds the control fields a turn needs (one
+# msgpack-encoded field each, plus "_v" version and "_s" schema); the answers hash holds one field
+# per answer and is only read on demand. A turn rewrites only the fields it changed.
+# Sessions from before the hash layout are one JSON string; they are still read and become
+# hashes on their next save.
+SESSION_SCHEMA_VERSION = 1
+
+# Wire codes for ConversationState. Append only: stored sessions refer to these numbers.
+STATE_CODES = {
+    "greeting": 0,
+    "interest_check": 1,
+    "experience_check": 2,
+    "fresher_qualification": 3,
+    "exp_details": 4,
+    "customer_story": 5,
+    "customer_retry": 6,
+    "festival_story": 7,
+    "festival_retry": 8,
+    "completed": 9,
+    "rejected": 10,
+}
+STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+
+def pack_session_fields(fields: dict) -> dict:
+    """Flat session fields (SessionData.fields) -> hash field values."""
+    return {
+        name: msgpack.packb(STATE_CODES[value] if name == 'state' else value, use_bin_type=True)
+        for name, value in fields.items()
+    }
+
+def unpack_session_answers(raw: dict) -> dict:
+    """HGETALL of an answers hash -> answers dict."""
+    return {name.decode("utf-8"): msgpack.unpackb(value, raw=False) for name, value in raw.items()}
+
+def unpack_session_hash(raw: dict) -> dict:
+    """HGETALL of a session hash -> session dict with its version, answers not loaded."""
+    schema = int(raw.get(b"_s", 0))
+    if schema != SESSION_SCHEMA_VERSION:
+        raise ValueError(f"Unknown session schema version {schema}")
+    data = {
+        'answers': {},
+        'answers_loaded': False,
+        'version': int(raw[b"_v"])
+    }
+    for name, value in raw.items():
+        name = name.decode("utf-8")
+        if name.startswith("_"):
+            continue
+        value = msgpack.unpackb(value, raw=False)
+        data[name] = STATE_NAMES[value] if name == 'state' else value
+    return data
+
+class SessionConflict(Exception):
+    """The session was saved by someone else since it was read."""
 
 class SessionManager:
-    def __init__(self):
+    # Optimistic concurrency plus a partial write in one round trip: the changed fields only land if the
+    # stored "_v" is still the version we read, and both hashes get their TTL refreshed with them.
+    # "a:<name>" fields go to the answers hash. A full write (a new session, or one read from a
+    # JSON string session, which counts as version 0) replaces the session key.
+    # The same call keeps the active-session index in step: the session is scored by its expiry in the
+    # "all" sorted set (KEYS[3]) and in its state's set (KEYS[4]), leaving its previous state's set (KEYS[5]).
+    # ARGV: expected version, ttl, replace flag, session id, expiry time, count of fields to remove,
+    # their names, then field/value pairs.
+    SAVE_SCRIPT = """
+    local current = 0
+    if redis.call('TYPE', KEYS[1])['ok'] == 'hash' then
+        current = tonumber(redis.call('HGET', KEYS[1], '_v') or '0')
+    end
+    if current ~= tonumber(ARGV[1]) then
+        return -1
+    end
+    if ARGV[3] == '1' then
+        redis.call('DEL', KEYS[1])
+    end
+    local function target(name)
+        if string.sub(name, 1, 2) == 'a:' then
+            return KEYS[2], string.sub(name, 3)
+        end
+        return KEYS[1], name
+    end
+    local removed = tonumber(ARGV[6])
+    for i = 7, 6 + removed do
+        local key, field = target(ARGV[i])
+        redis.call('HDEL', key, field)
+    end
+    for i = 7 + removed, #ARGV, 2 do
+        local key, field = target(ARGV[i])
+        redis.call('HSET', key, field, ARGV[i + 1])
+    end
+    redis.call('HSET', KEYS[1], '_v', current + 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    
+    local now = tonumber(ARGV[5]) - tonumber(ARGV[2])
+    if KEYS[5] ~= KEYS[4] then
+        redis.call('ZREM', KEYS[5], ARGV[4])
+    end
+    for i = 3, 4 do
+        redis.call('ZADD', KEYS[i], ARGV[5], ARGV[4])
+        redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now)
+    end
+    return current + 1
+    """
+    
+    TIMELINE_MAX_EVENTS = 500
+    
+    def __init__(self, client=None):
+        self.redis = client
         self.local_sessions = {}
+        self.local_timelines = {}
         self.ttl = 3600  # 1 hour
+        self.stats = {"saves": 0, "conflicts": 0, "fields_written": 0, "bytes_written": 0}
+        self._save_script = client.register_script(self.SAVE_SCRIPT) if client else None
     
-    def save(self, session_id: str, session_data):
-        """Save session to Redis or memory"""
-        try:
-            data = {
-                'state': session_data.state.value,
-                'candidate_type': session_data.candidate_type,
-                'retry_count': session_data.retry_count,
-                'answers': session_data.answers,
-                'phone_number': session_data.phone_number,
-                'conversation': session_data.conversation
-            }
+    def key(self, session_id: str) -> str:
+        return f"riya:session:{session_id}"
+    
+    def answers_key(self, session_id: str) -> str:
+        return f"riya:session-answers:{session_id}"
+    
+    def timeline_key(self, session_id: str) -> str:
+        return f"riya:timeline:{session_id}"
+    
+    def index_key(self, state: str = None) -> str:
+        """Active-session index: sessions scored by expiry, overall or for one state."""
+        return f"riya:sessions:{state}" if state else "riya:sessions:all"
+    
+    def _save_local(self, session_id: str, data: dict, expected: int) -> int:
+        stored = self.local_sessions.get(session_id)
+        current = stored.get('version', 0) if stored else 0
+        if current != expected:
+            return -1
+        self.local_sessions[session_id] = dict(data, version=current + 1)
+        return current + 1
+    
+    async def save(self, session_id: str, session_data):
+        """Save the fields this session changed to Redis (all of them to memory);
+        raises SessionConflict if it changed since it was read"""
+        with Timer(stage_seconds, "session_save") as timer:
+            try:
+                if self.redis:
+                    changed, removed = session_data.dirty_fields()
+                    packed = pack_session_fields(changed)
+                    replace = session_data.stored_fields is None
+                    if replace:
+                        packed['_s'] = str(SESSION_SCHEMA_VERSION)
+                    args = [session_data.version, self.ttl, int(replace), session_id, time.time() + self.ttl, len(removed), *removed]
+                    for name, value in packed.items():
+                        args += [name, value]
+                    # Only a session read from a hash can already be indexed, under the state it was read in
+                    state = session_data.state.value
+                    previous_state = session_data.stored_fields['state'] if not replace else state
+                    version = await self._save_script(
+                        keys=[
+                            self.key(session_id),
+                            self.answers_key(session_id),
+                            self.index_key(),
+                            self.index_key(state),
+                            self.index_key(previous_state)
+                        ],
+                        args=args
+                    )
+                    if version > 0:
+                        self.stats["fields_written"] += len(packed) + len(removed)
+                        self.stats["bytes_written"] += sum(len(name) + len(value) for name, value in packed.items())
+                else:
+                    version = self._save_local(session_id, session_data.to_dict(), session_data.version)
+            except Exception as e:
+                print(f"Redis save error: {e}, falling back to memory")
+                timer.outcome = "fallback"
+                version = session_data.version + 1
+                self.local_sessions[session_id] = dict(session_data.to_dict(), version=version)
             
-            if redis_client:
-                redis_client.setex(f"riya:session:{session_id}", self.ttl, json.dumps(data))
+            if version < 0:
+                self.stats["conflicts"] += 1
+                timer.outcome = "conflict"
+                raise SessionConflict(f"Session {session_id} changed since version {session_data.version}")
+        self.stats["saves"] += 1
+        session_data.version = version
+        session_data.mark_clean()
+    
+    async def get(self, session_id: str):
+        """Retrieve session from Redis or memory. Answers are left out (the conversation flow only
+        writes them; load_answers fetches them), so SessionData.answers holds just new ones."""
+        with Timer(stage_seconds, "session_get") as timer:
+            data = None
+            try:
+                if self.redis:
+                    try:
+                        raw = await self.redis.hgetall(self.key(session_id))
+                        if raw:
+                            data = unpack_session_hash(raw)
+                    except aioredis.ResponseError:
+                        # WRONGTYPE: a JSON string session written before the hash layout (version 0)
+                        legacy = await self.redis.get(self.key(session_id))
+                        if legacy:
+                            data = dict(json.loads(legacy), version=0)
+                if data is None:
+                    data = self.local_sessions.get(session_id)
+            except Exception as e:
+                print(f"Redis get error: {e}")
+                timer.outcome = "fallback"
+                data = self.local_sessions.get(session_id)
+            if data is None:
+                timer.outcome = "missing"
             else:
-                self.local_sessions[session_id] = data
+                # A turn learns its state from this read, so label the read itself directly
+                timer.state = data['state']
+            return data
+    
+    async def load_answers(self, session_id: str, session_data) -> dict:
+        """Fetch the stored answers into a session read without them; answers set since then win."""
+        if session_data.answers_loaded or not self.redis:
+            return session_data.answers
+        stored = unpack_session_answers(await self.redis.hgetall(self.answers_key(session_id)))
+        for name, answer in stored.items():
+            session_data.answers.setdefault(name, answer)
+            if session_data.stored_fields is not None:
+                session_data.stored_fields.setdefault(f"a:{name}", answer)
+        session_data.answers_loaded = True
+        return session_data.answers
+    
+    async def transition(self, session_id: str, step, attempts: int = 5, current: dict = None):
+        """Apply step(session) to the latest stored session and save it in one atomic write,
+        re-running step on a fresh read if another request saved first. current is a read the
+        caller already made, used for the first attempt. A step that returns None leaves the
+        session as it is and nothing is saved.
+        Returns (session, step's result), or (None, None) if the session does not exist."""
+        for attempt in range(attempts):
+            data = current if attempt == 0 and current is not None else await self.get(session_id)
+            session = SessionData.from_dict(data)
+            if session is None:
+                return None, None
+            result = step(session)
+            if result is None:
+                return session, None
+            try:
+                await self.save(session_id, session)
+                return session, result
+            except SessionConflict:
+                print(f"⚠️ Session {session_id} changed concurrently, retrying ({attempt + 1}/{attempts})")
+                # Jittered backoff so competing writers stop colliding on the next round
+                await asyncio.sleep(random.uniform(0, 0.005 * 2 ** attempt))
+        raise SessionConflict(f"Session {session_id} kept changing, gave up after {attempts} attempts")
+    
+    async def record_events(self, session_id: str, events: list):
+        """Append events to the session's call timeline (capped, expires with the session)"""
+        if not events:
+            return
+        try:
+            if self.redis:
+                key = self.timeline_key(session_id)
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.rpush(key, *[json.dumps(event) for event in events])
+                    pipe.ltrim(key, -self.TIMELINE_MAX_EVENTS, -1)
+                    pipe.expire(key, self.ttl)
+                    await pipe.execute()
+                return
         except Exception as e:
-            print(f"Redis save error: {e}, falling back to memory")
-            self.local_sessions[session_id] = data
+            print(f"Redis timeline error: {e}, falling back to memory")
+        timeline = self.local_timelines.setdefault(session_id, [])
+        timeline.extend(events)
+        del timeline[:-self.TIMELINE_MAX_EVENTS]
     
-    def get(self, session_id: str):
-        """Retrieve session from Redis or memory"""
+    async def timeline(self, session_id: str) -> list:
+        """Call timeline events, oldest first"""
         try:
-            if redis_client:
-                data = redis_client.get(f"riya:session:{session_id}")
-                if data:
-                    return json.loads(data)
-            return self.local_sessions.get(session_id)
+            if self.redis:
+                events = await self.redis.lrange(self.timeline_key(session_id), 0, -1)
+                if events:
+                    return [json.loads(event) for event in events]
         except Exception as e:
-            print(f"Redis get error: {e}")
-            return self.local_sessions.get(session_id)
+            print(f"Redis timeline error: {e}")
+        return list(self.local_timelines.get(session_id, []))
     
-    def delete(self, session_id: str):
+    async def active_counts(self):
+        """(live sessions, {state: live sessions}) from the index, O(log N) per count."""
+        if not self.redis:
+            by_state = {}
+            for data in self.local_sessions.values():
+                by_state[data['state']] = by_state.get(data['state'], 0) + 1
+            return len(self.local_sessions), by_state
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for state in (None, *STATE_CODES):
+                pipe.zcount(self.index_key(state), f"({now}", "+inf")
+            total, *counts = await pipe.execute()
+        return total, {state: count for state, count in zip(STATE_CODES, counts) if count}
+    
+    async def delete(self, session_id: str):
         """Delete session"""
         try:
-            if redis_client:
-                redis_client.delete(f"riya:session:{session_id}")
+            if self.redis:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.delete(
+                        self.key(session_id), self.answers_key(session_id), self.timeline_key(session_id)
+                    )
+                    for state in (None, *STATE_CODES):
+                        pipe.zrem(self.index_key(state), session_id)
+                    await pipe.execute()
             if session_id in self.local_sessions:
                 del self.local_sessions[session_id]
+            self.local_timelines.pop(session_id, None)
         except Exception as e:
             print(f"Redis delete error: {e}")
 
-session_mgr = SessionManager()
+session_mgr = SessionManager(redis_client)
 
 # ================= APP SETUP =================
 
@@ -131,62 +650,916 @@ class ConversationState(str, Enum):
     REJECTED = "rejected"
 
 class SessionData:
-    def __init__(self, phone_number=None, state=None, candidate_type=None, retry_count=0, answers=None, conversation=None):
+    def __init__(self, phone_number=None, state=None, candidate_type=None, retry_count=0, answers=None, conversation=None, turn=0, version=0):
         self.conversation = conversation or []
         self.state = state or ConversationState.GREETING
         self.candidate_type = candidate_type
         self.retry_count = retry_count
         self.answers = answers or {}
         self.phone_number = phone_number
+        self.turn = turn  # webhook turns answered so far
+        self.version = version  # stored version this copy was read at (0 = never saved)
         self.current_audio_url = None
+        self.stored_fields = None  # fields() as last read from / written to a session hash
+        self.answers_loaded = True  # False when read without answers: self.answers holds only new ones
     
     @classmethod
     def from_dict(cls, data):
         """Create SessionData from Redis dict"""
         if not data:
             return None
-        return cls(
+        session = cls(
             phone_number=data.get('phone_number'),
             state=ConversationState(data.get('state', 'greeting')),
             candidate_type=data.get('candidate_type'),
             retry_count=data.get('retry_count', 0),
-            answers=data.get('answers', {}),
-            conversation=data.get('conversation', [])
+            answers=dict(data.get('answers') or {}),
+            conversation=list(data.get('conversation') or []),
+            turn=data.get('turn', 0),
+            version=data.get('version', 0)
         )
+        session.answers_loaded = data.get('answers_loaded', True)
+        if session.version:
+            # Saved before, so stored as a hash: the next save only writes what changes
+            session.mark_clean()
+        return session
+    
+    def to_dict(self) -> dict:
+        return {
+            'state': self.state.value,
+            'candidate_type': self.candidate_type,
+            'retry_count': self.retry_count,
+            'answers': dict(self.answers),
+            'phone_number': self.phone_number,
+            'conversation': list(self.conversation),
+            'turn': self.turn
+        }
+    
+    def fields(self) -> dict:
+        """Flat stored form: one entry per field and one "a:<name>" entry per answer."""
+        fields = {
+            'state': self.state.value,
+            'candidate_type': self.candidate_type,
+            'retry_count': self.retry_count,
+            'turn': self.turn,
+            'phone_number': self.phone_number,
+            'conversation': self.conversation
+        }
+        for name, answer in self.answers.items():
+            fields[f"a:{name}"] = answer
+        return fields
+    
+    def mark_clean(self):
+        self.stored_fields = copy.deepcopy(self.fields())
+    
+    def dirty_fields(self):
+        """(changed fields, removed field names) since the session was read or saved;
+        every field if it was never stored as a hash."""
+        fields = self.fields()
+        if self.stored_fields is None:
+            return fields, []
+        changed = {
+            name: value for name, value in fields.items()
+            if name not in self.stored_fields or self.stored_fields[name] != value
+        }
+        removed = [name for name in self.stored_fields if name not in fields]
+        return changed, removed
+
+# ================= SINGLE-FLIGHT =================
+
+class SingleFlight:
+    """Concurrent callers with the same key share one in-flight call and its result.
+    With a Redis client, workers also coordinate through a lock and a short-lived shared result,
+    so results must be JSON-serializable."""
+    
+    RESULT_TTL = 60
+    
+    def __init__(self, name: str, redis_client=None, lock_ttl: float = 120, keep: float = 0):
+        """keep > 0 also replays a finished result to identical calls for that many seconds."""
+        self.name = name
+        self.redis = redis_client
+        self.lock_ttl_ms = int(lock_ttl * 1000)
+        self.keep = keep
+        self.result_ttl = max(self.RESULT_TTL, int(keep))
+        self.calls = {}
+        self.results = {}  # key -> (expires_at, result), insertion ordered so oldest first
+        self.stats = {"leaders": 0, "joined": 0, "joined_remote": 0, "replayed": 0, "redis_errors": 0}
+    
+    def _remember(self, key: str, task: asyncio.Future):
+        if task.cancelled() or task.exception() is not None:
+            return
+        now = asyncio.get_running_loop().time()
+        while self.results:
+            oldest = next(iter(self.results))
+            if self.results[oldest][0] > now:
+                break
+            del self.results[oldest]
+        self.results[key] = (now + self.keep, task.result())
+    
+    async def do(self, key: str, fn, timeout: float = None):
+        """Run fn() unless an identical call is already in flight. A caller that times out or
+        is cancelled stops waiting but leaves the shared call running for the others."""
+        if key in self.results and self.results[key][0] > asyncio.get_running_loop().time():
+            self.stats["replayed"] += 1
+            return self.results[key][1]
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lead(key, fn) if self.redis else fn())
+            self.calls[key] = task
+            self.stats["leaders"] += 1
+            task.add_done_callback(lambda t: self.calls.pop(key, None) if self.calls.get(key) is t else None)
+            if self.keep:
+                task.add_done_callback(lambda t: self._remember(key, t))
+        else:
+            self.stats["joined"] += 1
+        if timeout is None:
+            return await asyncio.shield(task)
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+    
+    async def _lead(self, key: str, fn):
+        lock_key = f"riya:flight:{self.name}:{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+        result_key = f"{lock_key}:result"
+        token = uuid.uuid4().hex
+        try:
+            while True:
+                raw = await self.redis.get(result_key)
+                if raw is not None:
+                    self.stats["joined_remote"] += 1
+                    return json.loads(raw)
+                if await self.redis.set(lock_key, token, nx=True, px=self.lock_ttl_ms):
+                    break
+                if not await self.redis.exists(lock_key):
+                    continue  # the other worker finished or gave up between our checks
+                await asyncio.sleep(0.05)
+        except Exception as e:
+            # Without Redis this worker still dedupes its own callers through self.calls
+            self.stats["redis_errors"] += 1
+            print(f"Single flight {self.name} Redis error: {e}, running locally")
+            return await fn()
+        try:
+            result = await fn()
+            try:
+                await self.redis.set(result_key, json.dumps(result), ex=self.result_ttl)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                print(f"Single flight {self.name} result not shared: {e}")
+            return result
+        finally:
+            # Release only our own lock (it may have expired and been taken over)
+            try:
+                await self.redis.eval(
+                    "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end return 0",
+                    1, lock_key, token
+                )
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                print(f"Single flight {self.name} lock left to expire: {e}")
+
+flight_redis = redis_client if SINGLE_FLIGHT_REDIS else None
+# A TTS flight's result is audio in the leader's store: other workers can only use it if they share that store
+tts_flights = SingleFlight("tts", flight_redis if SHARED_AUDIO_STORE else None, lock_ttl=TTS_TIMEOUT + 10)
+stt_flights = SingleFlight("stt", flight_redis, lock_ttl=180)
+# Webhook turns always dedupe through Redis when there is one: a Twilio retry may land on another worker
+webhook_turns = SingleFlight("turn", redis_client, lock_ttl=180, keep=WEBHOOK_REPLAY_TTL)
 
 # ================= AUDIO & AI FUNCTIONS =================
 
-def generate_tts(text: str, session_id: str) -> str:
-    """Generate TTS using CambAI REST API."""
-    try:
-        audio_id = f"{session_id}_{uuid.uuid4().hex[:8]}.wav"
-        audio_path = TEMP_AUDIO_DIR / audio_id
-        
-        url = "https://client.camb.ai/apis/tts-stream"
-        headers = {
-            "x-api-key": CAMB_API_KEY,
-            "Content-Type": "application/json"
+def tts_cache_key(text: str) -> str:
+    """Hash of everything that affects the rendered audio for a prompt."""
+    raw = json.dumps([text, TTS_VOICE_ID, TTS_SPEECH_MODEL, TTS_LANGUAGE, TTS_AUDIO_FORMAT])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+def cached_audio_id(text: str) -> str:
+    return f"tts_{tts_cache_key(text)}{AUDIO_FORMATS[TTS_AUDIO_FORMAT][0]}"
+
+def silence_audio(seconds: float = 0.25) -> bytes:
+    """A short pause in TTS_AUDIO_FORMAT, served in place of a sentence whose render failed."""
+    frames = int(8000 * seconds)
+    if TTS_AUDIO_FORMAT == "ulaw":
+        return b"\xff" * frames  # mu-law silence
+    pcm = b"\x00\x00" * frames
+    fmt = struct.pack("<HHIIHH", 1, 1, 8000, 16000, 2, 16)
+    return b"RIFF" + struct.pack("<I", 36 + len(pcm)) + b"WAVEfmt " + struct.pack("<I", len(fmt)) + fmt + b"data" + struct.pack("<I", len(pcm)) + pcm
+
+def audio_media_type(audio_id: str) -> str:
+    for ext, media_type in AUDIO_FORMATS.values():
+        if audio_id.endswith(ext):
+            return media_type
+    return "audio/wav"
+
+class WavStream:
+    """Incremental RIFF/WAVE parser; feed() accepts arbitrary chunk boundaries and returns whole PCM frames."""
+    
+    def __init__(self):
+        self._buf = b""
+        self.in_data = False
+        self.channels = 1
+        self.width = 2
+        self.rate = 8000
+    
+    def _parse_header(self) -> bool:
+        """Consume RIFF chunks up to 'data'; False if more bytes are needed."""
+        buf = self._buf
+        if len(buf) < 12:
+            return False
+        if buf[:4] != b"RIFF" or buf[8:12] != b"WAVE":
+            raise ValueError("Audio is not a WAV stream")
+        pos = 12
+        while len(buf) >= pos + 8:
+            chunk_id = buf[pos:pos + 4]
+            size = struct.unpack("<I", buf[pos + 4:pos + 8])[0]
+            if chunk_id == b"data":
+                # Streamed WAVs often carry a bogus data size, so read until EOF instead
+                self._buf = buf[pos + 8:]
+                self.in_data = True
+                return True
+            if len(buf) < pos + 8 + size:
+                return False
+            if chunk_id == b"fmt ":
+                fmt_tag, channels, rate, _, _, bits = struct.unpack("<HHIIHH", buf[pos + 8:pos + 24])
+                if fmt_tag not in (1, 0xFFFE) or channels not in (1, 2) or bits not in (8, 16, 24, 32):
+                    raise ValueError(f"Unsupported WAV format: tag={fmt_tag} channels={channels} bits={bits}")
+                self.channels, self.width, self.rate = channels, bits // 8, rate
+            pos += 8 + size + (size & 1)
+        return False
+    
+    def feed(self, data: bytes) -> bytes:
+        self._buf += data
+        if not self.in_data and not self._parse_header():
+            return b""
+        frame_size = self.channels * self.width
+        usable = len(self._buf) - len(self._buf) % frame_size
+        pcm, self._buf = self._buf[:usable], self._buf[usable:]
+        return pcm
+
+class UlawTranscoder:
+    """Incremental PCM WAV -> 8 kHz mono mu-law converter; feed() accepts arbitrary chunk boundaries."""
+    
+    def __init__(self):
+        self.wav = WavStream()
+        self._ratecv_state = None
+    
+    def feed(self, data: bytes) -> bytes:
+        pcm = self.wav.feed(data)
+        if not pcm:
+            return b""
+        width, rate = self.wav.width, self.wav.rate
+        if width == 1:
+            pcm = audioop.bias(pcm, 1, -128)  # 8-bit WAV samples are unsigned
+        if self.wav.channels == 2:
+            pcm = audioop.tomono(pcm, width, 0.5, 0.5)
+        if width != 2:
+            pcm = audioop.lin2lin(pcm, width, 2)
+        if rate != 8000:
+            pcm, self._ratecv_state = audioop.ratecv(pcm, 2, 1, rate, 8000, self._ratecv_state)
+        return audioop.lin2ulaw(pcm, 2)
+
+def transcode_audio(data: bytes) -> bytes:
+    """Convert a complete CambAI response to TTS_AUDIO_FORMAT (CPU bound, run it in a thread)."""
+    if TTS_AUDIO_FORMAT != "ulaw":
+        return data
+    return UlawTranscoder().feed(data)
+
+tts_http = None
+
+def get_tts_http() -> httpx.AsyncClient:
+    """Shared async client for CambAI, created lazily on first use."""
+    global tts_http
+    if tts_http is None or tts_http.is_closed:
+        tts_http = httpx.AsyncClient(
+            headers={"x-api-key": CAMB_API_KEY or ""},
+            timeout=httpx.Timeout(TTS_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=TTS_MAX_CONNECTIONS,
+                max_keepalive_connections=TTS_MAX_CONNECTIONS,
+                keepalive_expiry=120
+            )
+        )
+    return tts_http
+
+def camb_tts_payload(text: str) -> dict:
+    return {
+        "text": text,
+        "language": TTS_LANGUAGE,
+        "voice_id": TTS_VOICE_ID,
+        "speech_model": TTS_SPEECH_MODEL
+    }
+
+class StreamingSynthesis:
+    """An in-progress CambAI stream that /audio readers follow while it is written to the audio store."""
+    
+    def __init__(self, audio_id: str, text: str):
+        self.audio_id = audio_id
+        self.text = text
+        self.chunks = []
+        self.done = False
+        self.failed = False
+        self._changed = asyncio.Condition()
+        self.task = None
+    
+    async def _publish(self, chunk: bytes = None):
+        async with self._changed:
+            if chunk:
+                self.chunks.append(chunk)
+            self._changed.notify_all()
+    
+    async def run(self):
+        writer = None
+        started = tts_router.now()
+        try:
+            writer = audio_store.writer(self.audio_id)
+            async with get_tts_http().stream("POST", CAMB_TTS_URL, json=camb_tts_payload(self.text)) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"CambAI returned {response.status_code}")
+                transcoder = UlawTranscoder() if TTS_AUDIO_FORMAT == "ulaw" else None
+                async for chunk in response.aiter_bytes(8192):
+                    if transcoder:
+                        chunk = await asyncio.to_thread(transcoder.feed, chunk)
+                    if chunk:
+                        if not self.chunks:
+                            # Time to first byte is what the caller waits for in streaming mode
+                            tts_router.camb.record(tts_router.now() - started)
+                        await writer.write(chunk)
+                        await self._publish(chunk)
+            await writer.commit()
+        except Exception as e:
+            print(f"TTS stream error for {self.audio_id}: {e}")
+            tts_router.camb.record(ok=False)
+            self.failed = True
+            if writer is not None:
+                await writer.abort()
+        finally:
+            self.done = True
+            await self._publish()
+            active_tts_streams.pop(self.audio_id, None)
+    
+    async def wait_first_chunk(self) -> bool:
+        """Wait until audio starts flowing; False if the stream failed before any bytes."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.chunks or self.done)
+        return bool(self.chunks)
+    
+    async def iter_chunks(self):
+        sent = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: sent < len(self.chunks) or self.done)
+                pending = self.chunks[sent:]
+            for chunk in pending:
+                yield chunk
+            sent += len(pending)
+            if self.done and sent >= len(self.chunks):
+                return
+
+# audio_id -> StreamingSynthesis still receiving audio from CambAI
+active_tts_streams = {}
+
+def start_tts_stream(audio_id: str, text: str) -> StreamingSynthesis:
+    stream = active_tts_streams.get(audio_id)
+    if stream is None:
+        stream = StreamingSynthesis(audio_id, text)
+        active_tts_streams[audio_id] = stream
+        stream.task = asyncio.create_task(stream.run())
+    return stream
+
+async def camb_synthesize(text: str) -> bytes:
+    """One complete CambAI request, transcoded to TTS_AUDIO_FORMAT."""
+    async with get_tts_http().stream("POST", CAMB_TTS_URL, json=camb_tts_payload(text)) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"CambAI returned {response.status_code}")
+        audio = await response.aread()
+    if not audio:
+        raise RuntimeError("CambAI returned no audio")
+    return await asyncio.to_thread(transcode_audio, audio)
+
+class ProviderStats:
+    """EWMA latency and error rate of one TTS provider."""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.latency_ewma = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.last_attempt = 0.0
+    
+    def record(self, latency: float = None, ok: bool = True):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.error_rate += TTS_EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok and latency is not None:
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += TTS_EWMA_ALPHA * (latency - self.latency_ewma)
+    
+    @property
+    def degraded(self) -> bool:
+        return self.error_rate > TTS_MAX_ERROR_RATE or (self.latency_ewma or 0) > TTS_LATENCY_BUDGET
+    
+    def healthy(self, now: float) -> bool:
+        """Unhealthy providers still get one probe request per TTS_PROBE_INTERVAL."""
+        return not self.degraded or now - self.last_attempt >= TTS_PROBE_INTERVAL
+    
+    def snapshot(self) -> dict:
+        return {
+            "latency_ewma_ms": round(self.latency_ewma * 1000) if self.latency_ewma is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors
         }
-        payload = {
-            "text": text,
-            "language": "en-us",
-            "voice_id": 147320,
-            "speech_model": "mars-flash"
+
+class TtsRouter:
+    """Decides how a prompt is rendered: CambAI (hedged when slow) or Twilio <Say> within TTS_LATENCY_BUDGET."""
+    
+    def __init__(self):
+        self.camb = ProviderStats("camb")
+        self.decisions = {
+            "cache_hit": 0,
+            "synthesized": 0,
+            "hedged": 0,
+            "hedge_won": 0,
+            "streamed": 0,
+            "say_budget_exceeded": 0,
+            "say_provider_unhealthy": 0,
+            "say_provider_error": 0,
+            "segment_silenced": 0
         }
+    
+    def now(self) -> float:
+        return asyncio.get_running_loop().time()
+    
+    def hedge_delay(self) -> float:
+        if TTS_HEDGE_AFTER > 0:
+            return TTS_HEDGE_AFTER
+        if self.camb.latency_ewma is None:
+            return TTS_LATENCY_BUDGET / 2
+        return min(max(self.camb.latency_ewma * 1.5, 0.5), TTS_LATENCY_BUDGET / 2)
+    
+    def admit(self) -> bool:
+        """False means skip the provider and <Say> the prompt straight away."""
+        now = self.now()
+        if not self.camb.healthy(now):
+            self.decisions["say_provider_unhealthy"] += 1
+            return False
+        self.camb.last_attempt = now
+        return True
+    
+    async def attempt(self, text: str):
+        """A single unhedged CambAI request; None on failure."""
+        started = self.now()
+        try:
+            audio = await camb_synthesize(text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"TTS Error: {e}")
+            self.camb.record(ok=False)
+            return None
+        self.camb.record(self.now() - started)
+        return audio
+    
+    async def synthesize(self, text: str, on_late_result=None):
+        """Audio bytes, or None to fall back to <Say>. A request that outlives the budget
+        keeps running and hands its audio to on_late_result (used to fill the cache)."""
+        if not self.admit():
+            return None
+        deadline = self.now() + TTS_LATENCY_BUDGET
+        pending = {asyncio.create_task(self.attempt(text))}
+        done, _ = await asyncio.wait(pending, timeout=self.hedge_delay())
+        hedge = None
+        if not done:
+            hedge = asyncio.create_task(self.attempt(text))
+            pending.add(hedge)
+            self.decisions["hedged"] += 1
         
-        response = requests.post(url, json=payload, headers=headers, stream=True, timeout=60)
+        while pending:
+            remaining = deadline - self.now()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                audio = task.result()
+                if audio is not None:
+                    for other in pending:
+                        other.cancel()
+                    self.decisions["synthesized"] += 1
+                    if task is hedge:
+                        self.decisions["hedge_won"] += 1
+                    return audio
         
-        if response.status_code == 200:
-            with open(audio_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            return f"{PUBLIC_URL}/audio/{audio_id}"
+        if pending:
+            self.decisions["say_budget_exceeded"] += 1
+            if on_late_result is not None:
+                asyncio.create_task(self._deliver_late(pending, on_late_result))
+        else:
+            self.decisions["say_provider_error"] += 1
         return None
+    
+    async def _deliver_late(self, pending: set, on_late_result):
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                audio = task.result()
+                if audio is not None:
+                    for other in pending:
+                        other.cancel()
+                    try:
+                        await on_late_result(audio)
+                    except Exception as e:
+                        print(f"Late TTS result dropped: {e}")
+                    return
+    
+    def snapshot(self) -> dict:
+        return {
+            "budget_seconds": TTS_LATENCY_BUDGET,
+            "hedge_after_seconds": round(self.hedge_delay(), 3),
+            "providers": {self.camb.name: self.camb.snapshot()},
+            "decisions": self.decisions
+        }
+
+tts_router = TtsRouter()
+
+async def generate_tts(text: str, session_id: str) -> str:
+    """Generate TTS using CambAI REST API, reusing cached audio for repeated prompts.
+    Returns None when the caller should fall back to <Say>."""
+    try:
+        if TTS_CACHE_ENABLED:
+            audio_id = cached_audio_id(text)
+            if await audio_available(audio_id):
+                tts_router.decisions["cache_hit"] += 1
+                return f"{PUBLIC_URL}/audio/{audio_id}"
+        else:
+            audio_id = f"{session_id}_{uuid.uuid4().hex[:8]}{AUDIO_FORMATS[TTS_AUDIO_FORMAT][0]}"
+        
+        if TTS_STREAMING:
+            # Twilio fetches the URL while CambAI is still synthesizing
+            if audio_id not in active_tts_streams and not tts_router.admit():
+                return None
+            tts_router.decisions["streamed"] += 1
+            start_tts_stream(audio_id, text)
+            return f"{PUBLIC_URL}/audio/{audio_id}"
+        
+        async def store_late(audio: bytes):
+            await audio_store.write(audio_id, audio)
+        
+        async def render() -> bool:
+            audio = await tts_router.synthesize(text, on_late_result=store_late if TTS_CACHE_ENABLED else None)
+            if audio is None:
+                return False
+            await audio_store.write(audio_id, audio)
+            return True
+        
+        if TTS_CACHE_ENABLED:
+            # Calls hitting the same prompt at once share one synthesis (and one file)
+            try:
+                rendered = await tts_flights.do(audio_id, render, timeout=TTS_LATENCY_BUDGET)
+            except asyncio.TimeoutError:
+                tts_router.decisions["say_budget_exceeded"] += 1
+                return None
+        else:
+            rendered = await render()
+        return f"{PUBLIC_URL}/audio/{audio_id}" if rendered else None
     except Exception as e:
         print(f"TTS Error: {e}")
         return None
 
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+(?=[A-Z])")
+
+def tts_segments(text: str) -> list:
+    """Sentences of a long reply, each rendered and cached on its own; short replies stay whole."""
+    if not TTS_CACHE_ENABLED or not TTS_CHUNK_MIN_WORDS or len(text.split()) < TTS_CHUNK_MIN_WORDS:
+        return [text]
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+# audio_id -> render of a later sentence, still running after its webhook returned; /audio waits on it
+segment_renders = {}
+
+async def generate_tts_segments(text: str, session_id: str) -> list:
+    """<Play> URLs for a reply, one per entry of tts_segments(text); None to fall back to <Say>.
+    Every sentence starts rendering at once but only the first must be ready: /audio waits
+    for the in-flight render of later ones while Twilio plays the first. A later entry is None
+    when its render has already failed by then."""
+    segments = tts_segments(text)
+    if len(segments) == 1:
+        audio_url = await generate_tts(text, session_id)
+        return [audio_url] if audio_url else None
+    
+    renders = []
+    for segment in segments:
+        audio_id = cached_audio_id(segment)
+        render = asyncio.create_task(generate_tts(segment, session_id))
+        segment_renders[audio_id] = render
+        render.add_done_callback(
+            lambda t, audio_id=audio_id: segment_renders.pop(audio_id, None) if segment_renders.get(audio_id) is t else None
+        )
+        renders.append(render)
+    first_url = await renders[0]
+    if not first_url:
+        return None
+    return [first_url] + [
+        render.result() if render.done() else f"{PUBLIC_URL}/audio/{cached_audio_id(segment)}"
+        for segment, render in zip(segments[1:], renders[1:])
+    ]
+
+def twilio_media_auth():
+    if not TWILIO_MEDIA_AUTH:
+        return None
+    if TWILIO_API_KEY and TWILIO_API_SECRET:
+        return (TWILIO_API_KEY, TWILIO_API_SECRET)
+    return (TWILIO_SID, TWILIO_TOKEN)
+
+def authenticated_recording_url(recording_url: str) -> str:
+    """RecordingUrl with basic-auth credentials embedded, for a provider that fetches it directly."""
+    auth = twilio_media_auth()
+    if not auth:
+        return recording_url
+    parts = urlsplit(recording_url)
+    netloc = f"{quote(auth[0], safe='')}:{quote(auth[1], safe='')}@{parts.netloc}"
+    return urlunsplit(parts._replace(netloc=netloc))
+
+vad_stats = {"checked": 0, "skipped_short": 0, "skipped_silent": 0, "undecided": 0, "stt_calls_saved": 0}
+
+class SpeechDetector:
+    """Energy VAD over a streamed WAV: counts 20 ms frames louder than VAD_THRESHOLD_DBFS."""
+    
+    def __init__(self):
+        self.wav = WavStream()
+        self._pending = np.zeros(0, dtype=np.float32)
+        self.voiced_ms = 0
+        self.failed = False
+    
+    def _samples(self, pcm: bytes) -> np.ndarray:
+        """Frame-aligned PCM -> mono float samples in [-1, 1]."""
+        width = self.wav.width
+        if width == 1:
+            samples = (np.frombuffer(pcm, dtype=np.uint8).astype(np.float32) - 128) / 128
+        elif width == 3:
+            raw = np.frombuffer(pcm, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            samples = ((raw[:, 0] | raw[:, 1] << 8 | raw[:, 2] << 16) << 8 >> 8).astype(np.float32) / 2 ** 23
+        else:
+            dtype = "<i2" if width == 2 else "<i4"
+            samples = np.frombuffer(pcm, dtype=dtype).astype(np.float32) / 2 ** (8 * width - 1)
+        if self.wav.channels == 2:
+            samples = samples.reshape(-1, 2).mean(axis=1)
+        return samples
+    
+    def feed(self, data: bytes):
+        if self.failed:
+            return
+        try:
+            pcm = self.wav.feed(data)
+        except ValueError as e:
+            # Not a WAV we understand: let STT decide
+            print(f"⚠️ VAD skipped: {e}")
+            self.failed = True
+            return
+        if not pcm:
+            return
+        samples = np.concatenate((self._pending, self._samples(pcm)))
+        frame_len = max(1, self.wav.rate // 50)
+        frames = len(samples) // frame_len
+        if frames:
+            energy = np.mean(np.square(samples[:frames * frame_len].reshape(frames, frame_len)), axis=1)
+            dbfs = 10 * np.log10(energy + 1e-12)
+            self.voiced_ms += int(np.count_nonzero(dbfs > VAD_THRESHOLD_DBFS)) * 20
+        self._pending = samples[frames * frame_len:]
+    
+    def has_speech(self) -> bool:
+        """True unless the recording was parsed and stayed below the speech threshold."""
+        return self.failed or not self.wav.in_data or self.voiced_ms >= VAD_MIN_SPEECH_MS
+
+def recording_too_short(duration) -> bool:
+    """Twilio's RecordingDuration (seconds) says there is nothing worth transcribing."""
+    if not VAD_ENABLED or duration in (None, ""):
+        return False
+    try:
+        return float(duration) < VAD_MIN_DURATION
+    except ValueError:
+        return False
+
+class AsyncTranscriber:
+    """AssemblyAI over async REST: submit a job, then wait on a callback or poll with backoff."""
+    
+    def __init__(self):
+        self._api = None
+        self._media = None
+        self.limit = asyncio.Semaphore(STT_MAX_CONCURRENCY)
+        self.waiters = {}  # transcript_id -> asyncio.Event set by /stt-callback
+        self.stats = {
+            "max_concurrency": STT_MAX_CONCURRENCY,
+            "queued": 0,
+            "in_flight": 0,
+            "submitted": 0,
+            "completed": 0,
+            "errors": 0,
+            "callbacks": 0,
+            "callbacks_relayed": 0,
+            "polls": 0
+        }
+    
+    def api(self) -> httpx.AsyncClient:
+        if self._api is None or self._api.is_closed:
+            self._api = httpx.AsyncClient(
+                base_url=ASSEMBLYAI_API_URL,
+                headers={"authorization": ASSEMBLYAI_API_KEY or ""},
+                timeout=httpx.Timeout(60.0, connect=5.0)
+            )
+        return self._api
+    
+    def media(self) -> httpx.AsyncClient:
+        """Separate client for Twilio downloads, so AssemblyAI credentials never go to Twilio."""
+        if self._media is None or self._media.is_closed:
+            self._media = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=5.0), follow_redirects=True)
+        return self._media
+    
+    async def audio_url_for(self, recording_url: str, detector: SpeechDetector = None) -> str:
+        """AssemblyAI-readable URL for the recording; None if the detector already heard silence."""
+        if STT_INPUT_MODE == "url":
+            return authenticated_recording_url(recording_url)
+        
+        auth = twilio_media_auth()
+        if STT_INPUT_MODE == "stream":
+            async with self.media().stream("GET", recording_url, auth=auth) as download:
+                download.raise_for_status()
+                chunks = download.aiter_bytes(16384)
+                # Hold the download back until the detector hears VAD_MIN_SPEECH_MS of speech,
+                # so a silent recording never reaches the STT provider
+                prefix = []
+                if detector is not None:
+                    async for chunk in chunks:
+                        prefix.append(chunk)
+                        detector.feed(chunk)
+                        if detector.failed or detector.has_speech():
+                            break
+                    else:
+                        return None
+                
+                # Then relay the buffered prefix and the rest of the download into the upload
+                async def relay():
+                    for chunk in prefix:
+                        yield chunk
+                    async for chunk in chunks:
+                        yield chunk
+                
+                upload = await self.api().post("/upload", content=relay())
+        else:
+            download = await self.media().get(recording_url, auth=auth)
+            download.raise_for_status()
+            if detector is not None:
+                detector.feed(download.content)
+                if not detector.has_speech():
+                    return None
+            upload = await self.api().post("/upload", content=download.content)
+        upload.raise_for_status()
+        return upload.json()["upload_url"]
+    
+    async def submit(self, audio_url: str) -> str:
+        job = {
+            "audio_url": audio_url,
+            "speech_models": ["universal-2"],
+            "language_code": "en_us"
+        }
+        if STT_CALLBACK:
+            job["webhook_url"] = f"{PUBLIC_URL}/stt-callback"
+            job["webhook_auth_header_name"] = "X-Riya-Callback-Secret"
+            job["webhook_auth_header_value"] = STT_CALLBACK_SECRET
+        response = await self.api().post("/transcript", json=job)
+        response.raise_for_status()
+        self.stats["submitted"] += 1
+        return response.json()["id"]
+    
+    async def wait(self, transcript_id: str) -> dict:
+        """Poll with backoff; a callback for this job cuts the current wait short."""
+        event = self.waiters.setdefault(transcript_id, asyncio.Event())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STT_TIMEOUT
+        delay = 0.5
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"Transcript {transcript_id} not ready after {STT_TIMEOUT}s")
+                try:
+                    await asyncio.wait_for(event.wait(), min(delay, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+                self.stats["polls"] += 1
+                response = await self.api().get(f"/transcript/{transcript_id}")
+                response.raise_for_status()
+                transcript = response.json()
+                if transcript["status"] in ("completed", "error"):
+                    return transcript
+                delay = min(delay * 1.5, 3.0)
+        finally:
+            self.waiters.pop(transcript_id, None)
+    
+    def notify(self, transcript_id: str) -> bool:
+        """Wake this worker's wait for the transcript; False if no turn here is waiting on it."""
+        event = self.waiters.get(transcript_id)
+        if event is None:
+            return False
+        self.stats["callbacks"] += 1
+        event.set()
+        return True
+    
+    async def relay_callbacks(self, client):
+        """Wake local waiters for callbacks that /stt-callback received on another worker."""
+        while True:
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(STT_CALLBACK_CHANNEL)
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                        if message is not None:
+                            self.notify(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Turns keep polling meanwhile, so a lost subscription only costs latency
+                print(f"STT callback relay failed: {e}, resubscribing")
+                await asyncio.sleep(1)
+    
+    async def transcribe(self, recording_url: str, duration=None) -> str:
+        """Transcribe a Twilio recording ("" on a failed transcript or when there is no speech)."""
+        if recording_too_short(duration):
+            vad_stats["skipped_short"] += 1
+            vad_stats["stt_calls_saved"] += 1
+            print(f"Skipping STT: recording is {duration}s")
+            return ""
+        
+        self.stats["queued"] += 1
+        async with self.limit:
+            self.stats["queued"] -= 1
+            self.stats["in_flight"] += 1
+            try:
+                print(f"Transcribing {recording_url} with AssemblyAI ({STT_INPUT_MODE})...")
+                # "url" mode never sees the bytes, so only the duration check applies there
+                detector = SpeechDetector() if VAD_ENABLED and STT_INPUT_MODE != "url" else None
+                with Timer(stage_seconds, "download") as timer:
+                    # In "stream" mode this is the download, relayed into the upload once it has speech
+                    audio_url = await self.audio_url_for(recording_url, detector)
+                    if detector is not None and not detector.failed and not detector.has_speech():
+                        timer.outcome = "silent"
+                if detector is not None:
+                    vad_stats["checked"] += 1
+                    if detector.failed:
+                        vad_stats["undecided"] += 1
+                    elif not detector.has_speech():
+                        vad_stats["skipped_silent"] += 1
+                        vad_stats["stt_calls_saved"] += 1
+                        print(f"Skipping STT: {detector.voiced_ms} ms above {VAD_THRESHOLD_DBFS} dBFS")
+                        return ""
+                with Timer(stage_seconds, "stt") as timer:
+                    transcript_id = await self.submit(audio_url)
+                    transcript = await self.wait(transcript_id)
+                    if transcript["status"] == "error":
+                        timer.outcome = "failed"
+            except Exception:
+                self.stats["errors"] += 1
+                stt_errors.inc(metrics_state.get(), "request")
+                raise
+            finally:
+                self.stats["in_flight"] -= 1
+        
+        if transcript["status"] == "error":
+            self.stats["errors"] += 1
+            stt_errors.inc(metrics_state.get(), "transcript")
+            print(f"Transcription error: {transcript.get('error')}")
+            return ""
+        self.stats["completed"] += 1
+        return transcript.get("text") or ""
+    
+    async def close(self):
+        for client in (self._api, self._media):
+            if client is not None:
+                await client.aclose()
+
+stt_client = AsyncTranscriber()
+
+# ================= CONVERSATION FLOW =================
+
+# Every reply Riya can speak. Keep these constant: TTS audio is cached by text.
+PROMPT_GREETING = "Hi, this is Riya from Futuresoft Consultancy. We are hiring voice and chat profiles for companies like British Telecom, Teleperformance, and Wipro. Are you interested?"
+PROMPT_NOT_INTERESTED = "I understand. Thank you for your time. Have a great day!"
+PROMPT_ASK_EXPERIENCE = "We will surely help you with the same. Could you please confirm me if you are Fresher OR Experienced?"
+PROMPT_CONFIRM_INTEREST = "Could you please confirm if you are interested? Just say Yes or No."
+PROMPT_ASK_QUALIFICATION = "Now, what's your highest qualification like Graduate, Undergraduate, or Graduation drop-out?"
+PROMPT_ASK_EXP_DETAILS = "Now, please confirm your highest qualification and experience. Mention your job responsibility part clearly."
+PROMPT_CLARIFY_EXPERIENCE = "Could you please clarify - are you a Fresher or Experienced?"
+PROMPT_CUSTOMER_STORY = "That was very impressive. Could you please speak about any memorable interaction with customer within 10 to 12 sentences. You can start with, 'Once a customer called me for issue related to...' And your time starts now."
+PROMPT_FESTIVAL_STORY = "Acknowledgment to statement. Could you please speak about any latest festival you celebrated like Diwali, Holi, Christmas or Eid in 10 to 12 sentences. Start with, 'I celebrated my last Diwali along with family...' And your time starts now."
+PROMPT_REJECTED = "Sorry, we will not be able to help you with job as we hire candidates with good communication skills only."
+PROMPT_CUSTOMER_RETRY = "Sorry, you need to speak only 10 to 12 sentences on this topic. It can be done within 15 seconds only. Please speak on this topic now."
+PROMPT_COMPLETED = "That was amazing, now one of our HR Recruiter will connect you for your further interview process."
+PROMPT_FESTIVAL_RETRY = "Sorry, please speak clearly about the festival celebration for 10 to 12 sentences to proceed."
+PROMPT_GOODBYE = "Thank you for your time. Have a great day!"
+PROMPT_REPEAT = "I'm sorry, could you please repeat that?"
+PROMPT_STORY_EMPTY_RETRY = "Sorry, you need to speak on this topic. Please try now."
+PROMPT_DIDNT_CATCH = "I didn't catch that. Could you please speak up?"
+
 def check_story_quality(text: str) -> bool:
     sentences = re.split(r'[.!?]+', text)
     sentences = [s.strip() for s in sentences if s.strip()]
@@ -198,93 +1571,655 @@ def get_reply(session: SessionData, user_input: str) -> str:
     
     if current_state == ConversationState.GREETING:
         session.state = ConversationState.INTEREST_CHECK
-        return "Hi, this is Riya from Futuresoft Consultancy. We are hiring voice and chat profiles for companies like British Telecom, Teleperformance, and Wipro. Are you interested?"
+        return PROMPT_GREETING
     
     elif current_state == ConversationState.INTEREST_CHECK:
         if any(word in user_lower for word in ['no', 'not', 'nah', 'nope']):
-            return "I understand. Thank you for your time. Have a great day!"
+            return PROMPT_NOT_INTERESTED
         elif any(word in user_lower for word in ['yes', 'yeah', 'sure', 'interested', 'ok']):
             session.state = ConversationState.EXPERIENCE_CHECK
-            return "We will surely help you with the same. Could you please confirm me if you are Fresher OR Experienced?"
+            return PROMPT_ASK_EXPERIENCE
         else:
-            return "Could you please confirm if you are interested? Just say Yes or No."
+            return PROMPT_CONFIRM_INTEREST
     
     elif current_state == ConversationState.EXPERIENCE_CHECK:
         if any(word in user_lower for word in ['fresher', 'fresh', 'student']):
             session.candidate_type = 'fresher'
             session.state = ConversationState.FRESHER_QUALIFICATION
-            return "Now, what's your highest qualification like Graduate, Undergraduate, or Graduation drop-out?"
+            return PROMPT_ASK_QUALIFICATION
         elif any(word in user_lower for word in ['experience', 'experienced', 'worked']):
             session.candidate_type = 'experienced'
             session.state = ConversationState.EXP_DETAILS
-            return "Now, please confirm your highest qualification and experience. Mention your job responsibility part clearly."
+            return PROMPT_ASK_EXP_DETAILS
         else:
-            return "Could you please clarify - are you a Fresher or Experienced?"
+            return PROMPT_CLARIFY_EXPERIENCE
     
     elif current_state == ConversationState.FRESHER_QUALIFICATION:
         session.answers['qualification'] = user_input
         session.state = ConversationState.CUSTOMER_STORY
-        return "That was very impressive. Could you please speak about any memorable interaction with customer within 10 to 12 sentences. You can start with, 'Once a customer called me for issue related to...' And your time starts now."
+        return PROMPT_CUSTOMER_STORY
     
     elif current_state == ConversationState.EXP_DETAILS:
         session.answers['experience'] = user_input
         session.state = ConversationState.CUSTOMER_STORY
-        return "That was very impressive. Could you please speak about any memorable interaction with customer within 10 to 12 sentences. You can start with, 'Once a customer called me for issue related to...' And your time starts now."
+        return PROMPT_CUSTOMER_STORY
     
     elif current_state == ConversationState.CUSTOMER_STORY:
         is_valid = check_story_quality(user_input)
         if is_valid:
             session.answers['customer_story'] = user_input
             session.state = ConversationState.FESTIVAL_STORY
-            return "Acknowledgment to statement. Could you please speak about any latest festival you celebrated like Diwali, Holi, Christmas or Eid in 10 to 12 sentences. Start with, 'I celebrated my last Diwali along with family...' And your time starts now."
+            return PROMPT_FESTIVAL_STORY
         else:
             session.retry_count += 1
             if session.retry_count >= 2:
                 session.state = ConversationState.REJECTED
-                return "Sorry, we will not be able to help you with job as we hire candidates with good communication skills only."
+                return PROMPT_REJECTED
             else:
                 session.state = ConversationState.CUSTOMER_RETRY
-                return "Sorry, you need to speak only 10 to 12 sentences on this topic. It can be done within 15 seconds only. Please speak on this topic now."
+                return PROMPT_CUSTOMER_RETRY
     
     elif current_state == ConversationState.CUSTOMER_RETRY:
         is_valid = check_story_quality(user_input)
         if is_valid:
             session.answers['customer_story'] = user_input
             session.state = ConversationState.FESTIVAL_STORY
-            return "Acknowledgment to statement. Could you please speak about any latest festival you celebrated like Diwali, Holi, Christmas or Eid in 10 to 12 sentences. Start with, 'I celebrated my last Diwali along with family...' And your time starts now."
+            return PROMPT_FESTIVAL_STORY
         else:
             session.state = ConversationState.REJECTED
-            return "Sorry, we will not be able to help you with job as we hire candidates with good communication skills only."
+            return PROMPT_REJECTED
     
     elif current_state == ConversationState.FESTIVAL_STORY:
         is_valid = check_story_quality(user_input)
         if is_valid:
             session.answers['festival'] = user_input
             session.state = ConversationState.COMPLETED
-            return "That was amazing, now one of our HR Recruiter will connect you for your further interview process."
+            return PROMPT_COMPLETED
         else:
             session.retry_count += 1
             if session.retry_count >= 2:
                 session.state = ConversationState.REJECTED
-                return "Sorry, we will not be able to help you with job as we hire candidates with good communication skills only."
+                return PROMPT_REJECTED
             else:
                 session.state = ConversationState.FESTIVAL_RETRY
-                return "Sorry, please speak clearly about the festival celebration for 10 to 12 sentences to proceed."
+                return PROMPT_FESTIVAL_RETRY
     
     elif current_state == ConversationState.FESTIVAL_RETRY:
         is_valid = check_story_quality(user_input)
         if is_valid:
             session.answers['festival'] = user_input
             session.state = ConversationState.COMPLETED
-            return "That was amazing, now one of our HR Recruiter will connect you for your further interview process."
+            return PROMPT_COMPLETED
         else:
             session.state = ConversationState.REJECTED
-            return "Sorry, we will not be able to help you with job as we hire candidates with good communication skills only."
+            return PROMPT_REJECTED
     
     elif current_state in [ConversationState.REJECTED, ConversationState.COMPLETED]:
-        return "Thank you for your time. Have a great day!"
+        return PROMPT_GOODBYE
+    
+    return PROMPT_REPEAT
+
+def get_empty_input_reply(session: SessionData) -> str:
+    """Reply when a turn produced no speech (the greeting turn is handled by get_reply)."""
+    if session.state in [ConversationState.CUSTOMER_STORY, ConversationState.FESTIVAL_STORY]:
+        session.retry_count += 1
+        if session.retry_count >= 2:
+            session.state = ConversationState.REJECTED
+            return PROMPT_REJECTED
+        if session.state == ConversationState.CUSTOMER_STORY:
+            session.state = ConversationState.CUSTOMER_RETRY
+        else:
+            session.state = ConversationState.FESTIVAL_RETRY
+        return PROMPT_STORY_EMPTY_RETRY
+    return PROMPT_DIDNT_CATCH
+
+# The question each state is waiting on an answer to, repeated when a turn arrives twice
+STATE_PROMPTS = {
+    ConversationState.GREETING: PROMPT_GREETING,
+    ConversationState.INTEREST_CHECK: PROMPT_GREETING,
+    ConversationState.EXPERIENCE_CHECK: PROMPT_ASK_EXPERIENCE,
+    ConversationState.FRESHER_QUALIFICATION: PROMPT_ASK_QUALIFICATION,
+    ConversationState.EXP_DETAILS: PROMPT_ASK_EXP_DETAILS,
+    ConversationState.CUSTOMER_STORY: PROMPT_CUSTOMER_STORY,
+    ConversationState.CUSTOMER_RETRY: PROMPT_CUSTOMER_RETRY,
+    ConversationState.FESTIVAL_STORY: PROMPT_FESTIVAL_STORY,
+    ConversationState.FESTIVAL_RETRY: PROMPT_FESTIVAL_RETRY,
+    ConversationState.COMPLETED: PROMPT_COMPLETED,
+    ConversationState.REJECTED: PROMPT_REJECTED,
+}
+
+def advance_conversation(session: SessionData, user_input: str, is_first_call: bool = False) -> str:
+    """One turn of the flow, shared by the <Record> webhook and Media Streams."""
+    try:
+        if is_first_call:
+            # First call - play the greeting (state will advance to INTEREST_CHECK)
+            reply = get_reply(session, "")
+            print(f"First call - Riya greets: {reply[:60]}...")
+        elif not user_input or not user_input.strip():
+            # Empty input on subsequent calls (not first call)
+            reply = get_empty_input_reply(session)
+        else:
+            # Normal flow with user input
+            reply = get_reply(session, user_input)
+            print(f"Riya replies: {reply}")
+        return reply
+    except Exception as e:
+        print(f"Conversation flow error: {e}")
+        return PROMPT_REPEAT
+
+async def log_interview_result(session_id: str, session: SessionData):
+    """Log the outcome and every answer of a finished interview for the recruiters.
+    Turns never read the stored answers; this is the one place that loads them."""
+    try:
+        answers = await session_mgr.load_answers(session_id, session)
+    except Exception as e:
+        print(f"Loading answers for {session_id} failed: {e}")
+        answers = session.answers
+    print(f"📋 Interview {session.state.value} - Session: {session_id}, Phone: {session.phone_number}, Type: {session.candidate_type}")
+    for name, answer in answers.items():
+        print(f"   {name}: {answer}")
+
+# How each state collects the answer in CALL_AUDIO_MODE=record: "gather" for short answers
+# Twilio can recognise itself, "record" + batch STT for the long stories (the default)
+STATE_INPUT_MODES = {
+    ConversationState.INTEREST_CHECK: "gather",
+    ConversationState.EXPERIENCE_CHECK: "gather",
+}
+
+# Expected words per gather state, biasing Twilio's recognizer towards what get_reply matches
+GATHER_HINTS = {
+    ConversationState.INTEREST_CHECK: "yes, yeah, sure, ok, interested, no, not interested, nope",
+    ConversationState.EXPERIENCE_CHECK: "fresher, student, experienced, I have experience, worked",
+}
+
+def input_mode_for(state: ConversationState) -> str:
+    if not SPEECH_GATHER:
+        return "record"
+    return STATE_INPUT_MODES.get(state, "record")
+
+def listen_for_answer(response: VoiceResponse, session_id: str, state: ConversationState, turn: int):
+    """Append the TwiML that collects the caller's next answer and posts it back to the webhook."""
+    # turn tells a Twilio retry of this answer apart from the caller's next one
+    action = f"{PUBLIC_URL}/twilio-webhook?session_id={session_id}&turn={turn}"
+    if input_mode_for(state) == "gather":
+        print("Gathering next response...")
+        # actionOnEmptyResult posts silence back too, so the webhook can re-prompt
+        response.append(Gather(
+            input="speech",
+            action=action,
+            method="POST",
+            hints=GATHER_HINTS.get(state),
+            language=GATHER_LANGUAGE,
+            speech_timeout="auto",
+            timeout=GATHER_TIMEOUT,
+            action_on_empty_result=True
+        ))
+    else:
+        print("Recording next response...")
+        response.record(
+            action=action,
+            max_length=60,
+            play_beep=True,
+            trim="trim-silence",
+            timeout=5
+        )
+
+# ================= SPECULATIVE PRE-SYNTHESIS =================
+
+# Inputs that between them take every branch of get_reply / get_empty_input_reply
+PROBE_INPUTS = ["", "yes", "no", "fresher", "experienced", "hmm", " ".join(["word"] * 50)]
+
+def reachable_replies(session: SessionData) -> list:
+    """Replies the next turn can produce, found by dry-running the flow on copies of the session."""
+    replies = []
+    for probe in PROBE_INPUTS:
+        trial = copy.deepcopy(session)
+        reply = get_reply(trial, probe) if probe else get_empty_input_reply(trial)
+        if reply not in replies:
+            replies.append(reply)
+    return replies
+
+# session_id -> task warming the cache for that call's next turn
+speculation_tasks = {}
+speculation_stats = {"batches": 0, "warmed": 0, "already_cached": 0, "failed": 0, "cancelled": 0, "skipped_unhealthy": 0}
+
+async def warm_tts_cache(text: str):
+    audio_id = cached_audio_id(text)
+    if audio_id in active_tts_streams or await audio_available(audio_id):
+        speculation_stats["already_cached"] += 1
+        return
+    if tts_router.camb.degraded:
+        # Leave a struggling provider (and its probe requests) to live turns
+        speculation_stats["skipped_unhealthy"] += 1
+        return
     
-    return "I'm sorry, could you please repeat that?"
+    async def render() -> bool:
+        audio = await tts_router.attempt(text)
+        if audio is None:
+            return False
+        await audio_store.write(audio_id, audio)
+        return True
+    
+    if await tts_flights.do(audio_id, render):
+        speculation_stats["warmed"] += 1
+    else:
+        speculation_stats["failed"] += 1
+
+async def run_speculation(texts: list):
+    limit = asyncio.Semaphore(SPECULATION_CONCURRENCY)
+    
+    async def warm(text):
+        async with limit:
+            try:
+                await warm_tts_cache(text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                speculation_stats["failed"] += 1
+                print(f"Speculative TTS failed: {e}")
+    
+    await asyncio.gather(*(warm(text) for text in texts))
+
+def cancel_speculation(session_id: str):
+    task = speculation_tasks.pop(session_id, None)
+    if task is not None and not task.done():
+        task.cancel()
+        speculation_stats["cancelled"] += 1
+
+def start_speculation(session_id: str, session: SessionData):
+    """Warm the cache for every reply reachable from the session's state (one batch per call)."""
+    if not (SPECULATION_ENABLED and TTS_CACHE_ENABLED):
+        return
+    cancel_speculation(session_id)  # the previous turn's candidates are stale now
+    if session.state in [ConversationState.REJECTED, ConversationState.COMPLETED]:
+        return
+    texts = []
+    for reply in reachable_replies(session)[:SPECULATION_MAX_PROMPTS]:
+        texts.extend(segment for segment in tts_segments(reply) if segment not in texts)
+    task = asyncio.create_task(run_speculation(texts))
+    speculation_tasks[session_id] = task
+    speculation_stats["batches"] += 1
+    task.add_done_callback(
+        lambda t: speculation_tasks.pop(session_id, None) if speculation_tasks.get(session_id) is t else None
+    )
+
+# ================= PROMPT PACK =================
+
+PROMPT_PACK_MAGIC = b"RIYAPACK"
+PROMPT_PACK_VERSION = 1
+
+def conversation_prompts() -> list:
+    """Every PROMPT_* string in the conversation flow, in definition order."""
+    return [value for name, value in globals().items() if name.startswith("PROMPT_") and isinstance(value, str)]
+
+class PromptPack:
+    """Read-only, memory-mapped bundle of prompt audio.
+    Layout: magic, u16 version, u32 index length, JSON index, audio blobs.
+    Index entries are {audio_id: [offset, length]} with offsets relative to the first blob."""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = len(PROMPT_PACK_MAGIC) + 6
+        if self._mm[:len(PROMPT_PACK_MAGIC)] != PROMPT_PACK_MAGIC:
+            raise ValueError(f"{path} is not a prompt pack")
+        version, index_len = struct.unpack("<HI", self._mm[len(PROMPT_PACK_MAGIC):header_size])
+        if version != PROMPT_PACK_VERSION:
+            raise ValueError(f"{path} has pack version {version}, expected {PROMPT_PACK_VERSION}")
+        self.index = json.loads(self._mm[header_size:header_size + index_len])
+        self.entries = self.index["entries"]
+        self._base = header_size + index_len
+    
+    def __contains__(self, audio_id: str) -> bool:
+        return audio_id in self.entries
+    
+    def get(self, audio_id: str):
+        """Audio bytes straight from the page cache, or None."""
+        entry = self.entries.get(audio_id)
+        if entry is None:
+            return None
+        offset, length = entry
+        start = self._base + offset
+        return self._mm[start:start + length]
+    
+    @classmethod
+    def load(cls, path: Path):
+        if not path.exists():
+            return None
+        try:
+            pack = cls(path)
+            print(f"✅ Prompt pack loaded: {len(pack.entries)} prompts from {path}")
+            return pack
+        except Exception as e:
+            print(f"❌ Prompt pack ignored: {e}")
+            return None
+
+def write_prompt_pack(path: Path, audio_by_id: dict):
+    """Write audio blobs into a pack file, atomically replacing any existing one."""
+    entries = {}
+    offset = 0
+    for audio_id, audio in audio_by_id.items():
+        entries[audio_id] = [offset, len(audio)]
+        offset += len(audio)
+    index = {
+        "created": datetime.utcnow().isoformat(),
+        "format": TTS_AUDIO_FORMAT,
+        "voice_id": TTS_VOICE_ID,
+        "speech_model": TTS_SPEECH_MODEL,
+        "language": TTS_LANGUAGE,
+        "entries": entries
+    }
+    index_bytes = json.dumps(index).encode("utf-8")
+    
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.part")
+    with open(tmp_path, "wb") as f:
+        f.write(PROMPT_PACK_MAGIC)
+        f.write(struct.pack("<HI", PROMPT_PACK_VERSION, len(index_bytes)))
+        f.write(index_bytes)
+        for audio in audio_by_id.values():
+            f.write(audio)
+    os.replace(tmp_path, path)
+
+async def build_prompt_pack(path: Path) -> int:
+    """Render every conversation prompt (and its sentence segments) once and bundle them;
+    returns the number of failures."""
+    audio_by_id = {}
+    failures = 0
+    texts = []
+    for prompt in conversation_prompts():
+        texts.append(prompt)
+        texts.extend(tts_segments(prompt))
+    for text in texts:
+        audio_id = cached_audio_id(text)
+        if audio_id in audio_by_id:
+            continue
+        try:
+            audio_by_id[audio_id] = await camb_synthesize(text)
+            print(f"Rendered {audio_id}: {text[:50]}...")
+        except Exception as e:
+            failures += 1
+            print(f"❌ Could not render '{text[:50]}...': {e}")
+    if tts_http is not None:
+        await tts_http.aclose()
+    write_prompt_pack(path, audio_by_id)
+    print(f"Wrote {len(audio_by_id)} prompts to {path}")
+    return failures
+
+prompt_pack = PromptPack.load(PROMPT_PACK_PATH)
+
+async def audio_available(audio_id: str) -> bool:
+    return (prompt_pack is not None and audio_id in prompt_pack) or await audio_store.exists(audio_id)
+
+# ================= AUDIO GARBAGE COLLECTION =================
+
+TERMINAL_CALL_STATUSES = ["completed", "busy", "failed", "canceled", "no-answer"]
+
+audio_gc_stats = {"runs": 0, "files_reclaimed": 0, "bytes_reclaimed": 0}
+
+def reclaim_audio_file(path: Path):
+    try:
+        size = path.stat().st_size
+        path.unlink()
+    except FileNotFoundError:
+        return
+    audio_gc_stats["files_reclaimed"] += 1
+    audio_gc_stats["bytes_reclaimed"] += size
+
+def sweep_audio_dir():
+    """Evict per-call audio past AUDIO_MAX_AGE, then least recently used files over AUDIO_MAX_BYTES."""
+    now = datetime.now().timestamp()
+    entries = []
+    for path in TEMP_AUDIO_DIR.iterdir():
+        try:
+            if not path.is_file():
+                continue  # TTS_CACHE_DIR lives in here and is exempt
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        if now - st.st_mtime > AUDIO_MAX_AGE:
+            reclaim_audio_file(path)
+        else:
+            entries.append((st.st_mtime, st.st_size, path))
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= AUDIO_MAX_BYTES:
+            break
+        reclaim_audio_file(path)
+        total -= size
+    
+    # Partial writes orphaned by a crash mid-synthesis
+    for path in TTS_CACHE_DIR.glob("*.part"):
+        try:
+            if now - path.stat().st_mtime > AUDIO_MAX_AGE:
+                reclaim_audio_file(path)
+        except FileNotFoundError:
+            continue
+    audio_gc_stats["runs"] += 1
+
+def delete_session_audio(session_id: str):
+    """Drop every per-call file of a finished call."""
+    for path in TEMP_AUDIO_DIR.glob(f"{session_id}_*"):
+        reclaim_audio_file(path)
+
+async def audio_gc_loop():
+    """Periodically sweep the audio store off the event loop"""
+    while True:
+        try:
+            await audio_store.sweep()
+        except Exception as e:
+            print(f"Audio GC failed: {e}")
+        
+        await asyncio.sleep(AUDIO_GC_INTERVAL)
+
+# ================= AUDIO STORE =================
+
+class LocalAudioWriter:
+    """Writes to a temp name and renames on commit, so readers never see a partial file."""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex[:8]}.part")
+        self._file = open(self.tmp_path, "wb")
+    
+    async def write(self, chunk: bytes):
+        self._file.write(chunk)
+    
+    async def commit(self):
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+    
+    async def abort(self):
+        self._file.close()
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
+class LocalAudioStore:
+    """Audio on this instance's disk: cached prompts in TTS_CACHE_DIR, per-call audio in TEMP_AUDIO_DIR."""
+    
+    def path(self, audio_id: str) -> Path:
+        if audio_id.startswith("tts_"):
+            return TTS_CACHE_DIR / audio_id
+        return TEMP_AUDIO_DIR / audio_id
+    
+    async def exists(self, audio_id: str) -> bool:
+        return self.path(audio_id).exists()
+    
+    def writer(self, audio_id: str) -> LocalAudioWriter:
+        return LocalAudioWriter(self.path(audio_id))
+    
+    async def write(self, audio_id: str, data: bytes):
+        writer = self.writer(audio_id)
+        try:
+            await writer.write(data)
+            await writer.commit()
+        except Exception:
+            await writer.abort()
+            raise
+    
+    async def read(self, audio_id: str):
+        audio_path = self.path(audio_id)
+        if not audio_path.exists():
+            return None
+        return await asyncio.to_thread(audio_path.read_bytes)
+    
+    async def response(self, audio_id: str):
+        audio_path = self.path(audio_id)
+        if not audio_path.exists():
+            return None
+        if not audio_id.startswith("tts_"):
+            os.utime(audio_path)  # mark as recently used for the GC's size cap
+        return FileResponse(audio_path, media_type=audio_media_type(audio_id))
+    
+    async def delete_session(self, session_id: str):
+        await asyncio.to_thread(delete_session_audio, session_id)
+    
+    async def sweep(self):
+        await asyncio.to_thread(sweep_audio_dir)
+    
+    async def close(self):
+        pass
+
+class RedisAudioWriter:
+    """Appends chunks to a pending list that other instances can follow; RENAME publishes it."""
+    
+    def __init__(self, store, audio_id: str):
+        self.store = store
+        self.audio_id = audio_id
+        self.pending_key = f"{store.key(audio_id)}:pending:{uuid.uuid4().hex[:8]}"
+        self.size = 0
+        self._announced = False
+    
+    async def write(self, chunk: bytes):
+        client = self.store.client
+        pipe = client.pipeline(transaction=False)
+        pipe.rpush(self.pending_key, chunk)
+        pipe.expire(self.pending_key, int(TTS_TIMEOUT) + 60)
+        if not self._announced:
+            pipe.set(self.store.pending_pointer(self.audio_id), self.pending_key, ex=int(TTS_TIMEOUT) + 60)
+            self._announced = True
+        await pipe.execute()
+        self.size += len(chunk)
+    
+    async def commit(self):
+        client = self.store.client
+        final_key = self.store.key(self.audio_id)
+        if not self.size:
+            raise ValueError(f"No audio written for {self.audio_id}")
+        pipe = client.pipeline(transaction=True)
+        pipe.rename(self.pending_key, final_key)
+        if self.audio_id.startswith("tts_"):
+            pipe.persist(final_key)
+        else:
+            pipe.expire(final_key, AUDIO_MAX_AGE)
+            session_key = self.store.session_key(self.audio_id.split("_", 1)[0])
+            pipe.hset(session_key, self.audio_id, self.size)
+            pipe.expire(session_key, AUDIO_MAX_AGE)
+        pipe.delete(self.store.pending_pointer(self.audio_id))
+        await pipe.execute()
+    
+    async def abort(self):
+        await self.store.client.delete(self.pending_key, self.store.pending_pointer(self.audio_id))
+
+class RedisAudioStore:
+    """Audio as Redis lists of chunks, shared by every instance. Per-call audio expires via TTL."""
+    
+    READ_BATCH = 32
+    
+    def __init__(self, url: str):
+        # The session Redis already has a bounded pool: share it rather than opening a second one
+        if url == redis_url:
+            self.client = redis_client
+        else:
+            self.client = aioredis.Redis(connection_pool=bounded_redis_pool(url))
+    
+    def key(self, audio_id: str) -> str:
+        return f"riya:audio:{audio_id}"
+    
+    def pending_pointer(self, audio_id: str) -> str:
+        return f"riya:audio:{audio_id}:writer"
+    
+    def session_key(self, session_id: str) -> str:
+        return f"riya:audio:session:{session_id}"
+    
+    async def exists(self, audio_id: str) -> bool:
+        return bool(await self.client.exists(self.key(audio_id)))
+    
+    def writer(self, audio_id: str) -> RedisAudioWriter:
+        return RedisAudioWriter(self, audio_id)
+    
+    async def write(self, audio_id: str, data: bytes):
+        writer = self.writer(audio_id)
+        try:
+            await writer.write(data)
+            await writer.commit()
+        except Exception:
+            await writer.abort()
+            raise
+    
+    async def iter_chunks(self, key: str, start: int = 0):
+        while True:
+            chunks = await self.client.lrange(key, start, start + self.READ_BATCH - 1)
+            for chunk in chunks:
+                yield chunk
+            if len(chunks) < self.READ_BATCH:
+                return
+            start += len(chunks)
+    
+    async def follow_pending(self, audio_id: str, pending_key: str):
+        """Relay a synthesis running on another instance until it is published or abandoned."""
+        sent = 0
+        deadline = asyncio.get_running_loop().time() + TTS_TIMEOUT
+        while asyncio.get_running_loop().time() < deadline:
+            chunks = await self.client.lrange(pending_key, sent, -1)
+            if chunks:
+                for chunk in chunks:
+                    yield chunk
+                sent += len(chunks)
+                continue
+            if await self.client.exists(self.key(audio_id)):
+                async for chunk in self.iter_chunks(self.key(audio_id), sent):
+                    yield chunk
+                return
+            if not await self.client.exists(pending_key):
+                return
+            await asyncio.sleep(0.05)
+    
+    async def read(self, audio_id: str):
+        chunks = await self.client.lrange(self.key(audio_id), 0, -1)
+        return b"".join(chunks) if chunks else None
+    
+    async def response(self, audio_id: str):
+        media_type = audio_media_type(audio_id)
+        if await self.exists(audio_id):
+            return StreamingResponse(self.iter_chunks(self.key(audio_id)), media_type=media_type)
+        pending_key = await self.client.get(self.pending_pointer(audio_id))
+        if pending_key:
+            return StreamingResponse(self.follow_pending(audio_id, pending_key.decode()), media_type=media_type)
+        return None
+    
+    async def delete_session(self, session_id: str):
+        session_key = self.session_key(session_id)
+        sizes = await self.client.hgetall(session_key)
+        if sizes:
+            await self.client.delete(*(self.key(audio_id.decode()) for audio_id in sizes), session_key)
+            audio_gc_stats["files_reclaimed"] += len(sizes)
+            audio_gc_stats["bytes_reclaimed"] += sum(int(size) for size in sizes.values())
+    
+    async def sweep(self):
+        # Per-call audio carries a TTL; Redis maxmemory policy bounds the rest
+        audio_gc_stats["runs"] += 1
+    
+    async def close(self):
+        if self.client is not redis_client:
+            await self.client.aclose()
+
+if SHARED_AUDIO_STORE:
+    audio_store = RedisAudioStore(AUDIO_STORE_REDIS_URL)
+    print("✅ Audio store: Redis")
+else:
+    audio_store = LocalAudioStore()
 
 # ================= KEEP-ALIVE & HEALTH =================
 
@@ -308,28 +2243,85 @@ async def keep_alive_ping():
 
 @app.on_event("startup")
 async def startup_event():
-    """Start background tasks"""
+    """Check Redis and start background tasks"""
+    if redis_client is not None:
+        try:
+            await redis_client.ping()
+            print("✅ Redis connected")
+        except Exception as e:
+            # Same as running without REDIS_URL: this process keeps sessions and flights to itself
+            print(f"❌ Redis connection failed: {e}, using in-memory sessions")
+            session_mgr.redis = None
+            for flights in (tts_flights, stt_flights, webhook_turns):
+                flights.redis = None
+    if STT_CALLBACK and session_mgr.redis is not None:
+        asyncio.create_task(stt_client.relay_callbacks(session_mgr.redis))
     asyncio.create_task(keep_alive_ping())
+    asyncio.create_task(audio_gc_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled HTTP and audio store connections"""
+    if tts_http is not None:
+        await tts_http.aclose()
+    await audio_store.close()
+    await stt_client.close()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint for keep-alive and monitoring"""
-    active_sessions = 0
+    active_sessions, sessions_by_state = 0, {}
     try:
-        if redis_client:
-            active_sessions = len(redis_client.keys("riya:session:*"))
-        else:
-            active_sessions = len(session_mgr.local_sessions)
-    except:
-        pass
+        active_sessions, sessions_by_state = await session_mgr.active_counts()
+    except Exception as e:
+        print(f"Active session count failed: {e}")
     
     return {
         "status": "alive",
         "timestamp": datetime.utcnow().isoformat(),
         "active_sessions": active_sessions,
-        "redis_connected": redis_client is not None
+        "sessions_by_state": sessions_by_state,
+        "redis_connected": session_mgr.redis is not None,
+        "sessions": session_mgr.stats,
+        "redis_pool": redis_pool_stats(),
+        "audio_gc": audio_gc_stats,
+        "tts_router": tts_router.snapshot(),
+        "speculation": speculation_stats,
+        "single_flight": {"tts": tts_flights.stats, "stt": stt_flights.stats, "webhook": webhook_turns.stats},
+        "stt": stt_client.stats,
+        "vad": vad_stats
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint: per-stage turn latency plus the /health counters."""
+    lines = []
+    for metric in (stage_seconds, turn_seconds, tts_fallbacks, stt_errors):
+        lines.extend(metric.render())
+    lines.extend(stats_metrics("riya_sessions", session_mgr.stats))
+    lines.extend(stats_metrics("riya_redis_pool", redis_pool_stats()))
+    lines.extend(stats_metrics("riya_stt", stt_client.stats))
+    lines.extend(stats_metrics("riya_vad", vad_stats))
+    lines.extend(stats_metrics("riya_tts_router", tts_router.snapshot()))
+    lines.extend(stats_metrics("riya_speculation", speculation_stats))
+    lines.extend(stats_metrics("riya_audio_gc", audio_gc_stats))
+    for name, flights in (("tts", tts_flights), ("stt", stt_flights), ("webhook", webhook_turns)):
+        lines.extend(stats_metrics(f"riya_single_flight_{name}", flights.stats))
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/calls/{session_id}/timeline")
+async def call_timeline(session_id: str):
+    """Structured timeline of one call: dial, status callbacks and every turn's stages."""
+    events = await session_mgr.timeline(session_id)
+    if not events:
+        raise HTTPException(status_code=404, detail="No timeline for this session")
+    started = events[0]["at"]
+    for event in events:
+        event["offset"] = round(event["at"] - started, 4)
+    return {"session_id": session_id, "events": events}
+
 # ================= TWILIO CALL HANDLING =================
 
 @app.post("/initiate-call")
@@ -343,7 +2335,7 @@ async def initiate_call(phone_number: str = Form(...)):
     session = SessionData(phone_number=phone_number)
     
     # Save to Redis immediately (CRITICAL for Render restarts)
-    session_mgr.save(session_id, session)
+    await session_mgr.save(session_id, session)
     print(f"Session created and saved: {session_id}")
     
     # DO NOT call get_reply here - let the webhook handle the first greeting
@@ -358,6 +2350,7 @@ async def initiate_call(phone_number: str = Form(...)):
             status_callback_event=["completed", "answered"],
             machine_detection="Enable"
         )
+        await session_mgr.record_events(session_id, [trace_event("dial", call_sid=call.sid)])
         
         return {
             "success": True, 
@@ -373,147 +2366,490 @@ async def twilio_webhook(
     request: Request, 
     session_id: str = None, 
     RecordingUrl: str = None,
-    CallStatus: str = None
+    CallStatus: str = None,
+    turn: int = 0
 ):
     """Handle Twilio webhooks with Redis session recovery."""
-    response = VoiceResponse()
+    # Twilio posts its own parameters as a form body; only session_id and turn are in our query string
+    form = await request.form()
+    RecordingUrl = RecordingUrl or form.get("RecordingUrl")
+    CallStatus = CallStatus or form.get("CallStatus")
+    CallSid = form.get("CallSid")
     
-    print(f"Webhook called - Session: {session_id}, Recording: {RecordingUrl}, Status: {CallStatus}")
+    print(f"Webhook called - Session: {session_id}, Turn: {turn}, Recording: {RecordingUrl}, Status: {CallStatus}")
     
     if not session_id:
         print("ERROR: No session_id provided")
+        response = VoiceResponse()
         response.say("Sorry, invalid session. Please call again.")
         return Response(content=str(response), media_type="application/xml")
     
+    async def process():
+        with Timer(turn_seconds) as timer:
+            return await process_turn(
+                session_id, turn, RecordingUrl, form.get("RecordingDuration"), form.get("SpeechResult"), form.get("Confidence"), timer
+            )
+    
+    # Stages of this turn collect their events here; they reach the call timeline in one write
+    trace = [trace_event("webhook", turn=turn, call_sid=CallSid, recording_sid=form.get("RecordingSid"), gather="SpeechResult" in form)]
+    turn_trace.set(trace)
+    started = time.perf_counter()
+    try:
+        if CallSid:
+            # Twilio retries a slow webhook: the retry waits for (or replays) the first attempt's TwiML
+            # instead of transcribing and advancing the conversation a second time
+            twiml_content = await webhook_turns.do(f"{CallSid}:{turn}:{form.get('RecordingSid') or ''}", process)
+        else:
+            twiml_content = await process()
+        trace.append(trace_event("twiml", turn=turn, seconds=round(time.perf_counter() - started, 4), bytes=len(twiml_content)))
+    finally:
+        await session_mgr.record_events(session_id, trace)
+    
+    return Response(content=twiml_content, media_type="application/xml")
+
+async def process_turn(
+    session_id: str,
+    turn: int,
+    RecordingUrl: str,
+    RecordingDuration: str,
+    SpeechResult: str,
+    Confidence: str,
+    timer: Timer
+) -> str:
+    """One webhook turn: recognise the answer, advance the session and render the TwiML reply."""
+    response = VoiceResponse()
+    
     # Load session from Redis (survives Render restarts!)
-    session_data = session_mgr.get(session_id)
+    session_data = await session_mgr.get(session_id)
     if not session_data:
         print("ERROR: Session not found in Redis")
+        timer.outcome = "expired"
         response.say("Sorry, this session has expired. Please call again.")
-        return Response(content=str(response), media_type="application/xml")
+        return str(response)
     
-    session = SessionData.from_dict(session_data)
-    print(f"Session loaded: {session_id}, State: {session.state}")
+    # Every stage of this turn is labelled with the state being answered
+    metrics_state.set(session_data['state'])
+    print(f"Session loaded: {session_id}, State: {session_data['state']}")
     
-    # Process recording if present
-    if RecordingUrl:
+    # Process the answer: already transcribed by <Gather>, or a recording to transcribe
+    if SpeechResult is not None:
+        user_input = SpeechResult
+        print(f"User said (gather, confidence {Confidence}): {user_input}")
+    elif RecordingUrl:
         try:
-            print(f"Downloading recording from: {RecordingUrl}")
-            audio_content = requests.get(RecordingUrl, timeout=30).content
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-                tmp.write(audio_content)
-                tmp_path = tmp.name
-            
-            print("Transcribing with AssemblyAI...")
-            config = aai.TranscriptionConfig(
-                speech_models=["universal-2"], 
-                language_code="en_us"
-            )
-            transcriber = aai.Transcriber(config=config)
-            transcript = transcriber.transcribe(tmp_path)
-            
-            os.unlink(tmp_path)
-            
-            if transcript.status == "error":
-                print(f"Transcription error: {transcript.error}")
-                user_input = ""
-            else:
-                user_input = transcript.text
-                print(f"User said: {user_input}")
-                
+            # A Twilio retry of this turn shares the transcription already in flight
+            user_input = await stt_flights.do(RecordingUrl, lambda: stt_client.transcribe(RecordingUrl, RecordingDuration))
+            print(f"User said: {user_input}")
         except Exception as e:
             print(f"Transcription failed: {e}")
             user_input = ""
     else:
+        # Also the <Gather> timeout: actionOnEmptyResult posts without a SpeechResult
         print("No recording received")
         user_input = ""
     
-    # CRITICAL FIX: Check if this is the first call (no recording + GREETING state)
-    is_first_call = (not RecordingUrl) and (session.state == ConversationState.GREETING)
+    def step(session):
+        if session.turn != turn:
+            # This answer was already applied (a duplicate that got past webhook_turns): don't apply it twice
+            return None
+        # CRITICAL FIX: Check if this is the first call (no recording + GREETING state)
+        is_first_call = (not RecordingUrl) and (session.state == ConversationState.GREETING)
+        session.turn += 1
+        with Timer(stage_seconds, "get_reply"):
+            return advance_conversation(session, user_input, is_first_call)
     
-    # Get reply from conversation flow
-    try:
-        if is_first_call:
-            # First call - play the greeting (state will advance to INTEREST_CHECK)
-            reply = get_reply(session, "")
-            print(f"First call - Riya greets: {reply[:60]}...")
-        elif not user_input or not user_input.strip():
-            # Empty input on subsequent calls (not first call)
-            if session.state in [ConversationState.CUSTOMER_STORY, ConversationState.FESTIVAL_STORY]:
-                session.retry_count += 1
-                if session.retry_count >= 2:
-                    session.state = ConversationState.REJECTED
-                    reply = "Sorry, we will not be able to help you with job as we hire candidates with good communication skills only."
-                else:
-                    if session.state == ConversationState.CUSTOMER_STORY:
-                        session.state = ConversationState.CUSTOMER_RETRY
-                    else:
-                        session.state = ConversationState.FESTIVAL_RETRY
-                    reply = "Sorry, you need to speak on this topic. Please try now."
-            else:
-                reply = "I didn't catch that. Could you please speak up?"
-        else:
-            # Normal flow with user input
-            reply = get_reply(session, user_input)
-            print(f"Riya replies: {reply}")
-        
-    except Exception as e:
-        print(f"Conversation flow error: {e}")
-        reply = "I'm sorry, could you please repeat that?"
+    # Advance the conversation and save it in one atomic write (survives Render restarts and
+    # overlapping requests: a concurrent save makes us re-apply the turn to the newer session)
+    session, reply = await session_mgr.transition(session_id, step, current=session_data)
+    if session is None:
+        print("ERROR: Session disappeared during the turn")
+        timer.outcome = "expired"
+        response.say("Sorry, this session has expired. Please call again.")
+        return str(response)
+    duplicate = reply is None
+    if duplicate:
+        print(f"⚠️ Turn {turn} of {session_id} was already answered (session is at turn {session.turn}), repeating the question")
+        timer.outcome = "duplicate"
+        reply = STATE_PROMPTS.get(session.state, PROMPT_REPEAT)
+        turn_trace.get().append(trace_event("duplicate_turn", turn=turn, session_turn=session.turn))
+    else:
+        turn_trace.get().append(trace_event("transition", from_state=session_data['state'], to_state=session.state.value))
     
     # Generate TTS with fallback
-    audio_url = None
+    audio_urls = None
     try:
         if reply:
-            audio_url = generate_tts(reply, session_id)
-            session.current_audio_url = audio_url
+            with Timer(stage_seconds, "tts") as tts_timer:
+                audio_urls = await generate_tts_segments(reply, session_id)
+                if not audio_urls:
+                    tts_timer.outcome = "failed"
+                elif None in audio_urls:
+                    tts_timer.outcome = "partial"
+            session.current_audio_url = audio_urls[0] if audio_urls else None
     except Exception as e:
         print(f"TTS generation failed: {e}")
-        audio_url = None
+        audio_urls = None
     
     # Build TwiML response
-    if audio_url:
-        print(f"Playing audio: {audio_url}")
-        response.play(audio_url)
+    if audio_urls:
+        if None in audio_urls:
+            tts_fallbacks.inc(metrics_state.get())
+        for segment, audio_url in zip(tts_segments(reply), audio_urls):
+            if audio_url:
+                print(f"Playing audio: {audio_url}")
+                response.play(audio_url)
+            else:
+                print(f"Using fallback TTS for: {segment}")
+                response.say(segment, voice="Polly.Joanna", language="en-US")
     else:
         print("Using fallback TTS")
+        tts_fallbacks.inc(metrics_state.get())
+        timer.outcome = "fallback"
         response.say(reply, voice="Polly.Joanna", language="en-US")
     
     # Continue or hang up
-    if session.state not in [ConversationState.REJECTED, ConversationState.COMPLETED]:
-        print("Recording next response...")
-        response.record(
-            action=f"{PUBLIC_URL}/twilio-webhook?session_id={session_id}",
-            max_length=60,
-            play_beep=True,
-            trim="trim-silence",
-            timeout=5
-        )
+    if session.state not in [ConversationState.REJECTED, ConversationState.COMPLETED] and CALL_AUDIO_MODE == "stream":
+        print("Connecting media stream...")
+        connect_media_stream(response, session_id)
+    elif session.state not in [ConversationState.REJECTED, ConversationState.COMPLETED]:
+        listen_for_answer(response, session_id, session.state, session.turn)
     else:
         print("Conversation ended")
         response.hangup()
+        if not duplicate:
+            await log_interview_result(session_id, session)
     
-    # CRITICAL: Save session back to Redis after processing
-    session_mgr.save(session_id, session)
+    # Render the possible next replies while Twilio records the answer
+    start_speculation(session_id, session)
     
     twiml_content = str(response)
     print(f"TwiML length: {len(twiml_content)} chars")
     
-    return Response(content=twiml_content, media_type="application/xml")
+    return twiml_content
+
+@app.post("/stt-callback")
+async def stt_callback(request: Request):
+    """AssemblyAI job-completion webhook; wakes the turn waiting on that transcript."""
+    if request.headers.get("X-Riya-Callback-Secret") != STT_CALLBACK_SECRET:
+        raise HTTPException(status_code=403, detail="Invalid callback secret")
+    payload = await request.json()
+    transcript_id = payload.get("transcript_id")
+    if transcript_id and not stt_client.notify(transcript_id) and session_mgr.redis is not None:
+        # The turn waiting on this transcript is on another worker
+        try:
+            await session_mgr.redis.publish(STT_CALLBACK_CHANNEL, transcript_id)
+            stt_client.stats["callbacks_relayed"] += 1
+        except Exception as e:
+            print(f"STT callback relay failed: {e}")
+    return {"status": "ok"}
 
 @app.post("/call-status")
-async def call_status(session_id: str = None, CallStatus: str = None):
+async def call_status(request: Request, session_id: str = None, CallStatus: str = None):
     """Handle call status callbacks."""
+    # Twilio posts the status in the form body
+    form = await request.form()
+    CallStatus = CallStatus or form.get("CallStatus")
     print(f"Call status for {session_id}: {CallStatus}")
     
-    # Optional: Clean up completed sessions after some time
-    if CallStatus in ["completed", "busy", "failed", "canceled"]:
-        # Keep for a bit for debugging, then delete
-        pass
+    if session_id:
+        event = "answered" if CallStatus == "in-progress" else "call_status"
+        await session_mgr.record_events(session_id, [trace_event(event, status=CallStatus, duration=form.get("CallDuration"))])
+    
+    if session_id and CallStatus in TERMINAL_CALL_STATUSES:
+        # Keep the session for a bit for debugging, but its audio is no longer needed
+        cancel_speculation(session_id)
+        await audio_store.delete_session(session_id)
     
     return {"status": "ok"}
 
+# ================= MEDIA STREAMS (REAL-TIME STT) =================
+
+class StreamingRecognizer(ABC):
+    """Interface for streaming STT: feed 8 kHz mu-law frames, iterate (text, is_final) results."""
+    
+    async def start(self):
+        pass
+    
+    @abstractmethod
+    async def feed(self, ulaw: bytes):
+        ...
+    
+    @abstractmethod
+    async def finish(self):
+        """No more audio; results() ends once pending segments are delivered."""
+    
+    @abstractmethod
+    def results(self):
+        """Async iterator of (text, is_final) pairs."""
+    
+    async def close(self):
+        pass
+
+class FakeStreamingRecognizer(StreamingRecognizer):
+    """Local stand-in for tests: energy-based endpointing that finalizes scripted transcripts."""
+    
+    def __init__(self, script=None, threshold: int = 500, silence_ms: int = 600):
+        self.script = list(script or [])
+        self.threshold = threshold
+        self.silence_ms = silence_ms
+        self._queue = asyncio.Queue()
+        self._in_speech = False
+        self._silent_for = 0
+    
+    async def feed(self, ulaw: bytes):
+        loud = audioop.rms(audioop.ulaw2lin(ulaw, 2), 2) >= self.threshold
+        if loud:
+            if not self._in_speech:
+                self._in_speech = True
+                await self._queue.put((self.script[0] if self.script else "", False))
+            self._silent_for = 0
+        elif self._in_speech:
+            self._silent_for += len(ulaw) // 8  # 8 bytes per ms
+            if self._silent_for >= self.silence_ms:
+                self._in_speech = False
+                self._silent_for = 0
+                await self._queue.put((self.script.pop(0) if self.script else "", True))
+    
+    async def finish(self):
+        await self._queue.put(None)
+    
+    async def results(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            yield item
+
+class AssemblyAIStreamingRecognizer(StreamingRecognizer):
+    """AssemblyAI Universal Streaming (v3) over a websocket, fed Twilio's mu-law as-is."""
+    
+    URL = "wss://streaming.assemblyai.com/v3/ws"
+    CHUNK_BYTES = 800  # 100 ms; the API wants 50-1000 ms of audio per message
+    
+    def __init__(self):
+        self._ws = None
+        self._buf = b""
+    
+    async def start(self):
+        params = urlencode({"sample_rate": 8000, "encoding": "pcm_mulaw", "format_turns": "true"})
+        self._ws = await ws_connect(f"{self.URL}?{params}", additional_headers={"Authorization": ASSEMBLYAI_API_KEY or ""})
+    
+    async def feed(self, ulaw: bytes):
+        self._buf += ulaw
+        if len(self._buf) >= self.CHUNK_BYTES:
+            chunk, self._buf = self._buf, b""
+            await self._ws.send(chunk)
+    
+    async def finish(self):
+        try:
+            if self._buf:
+                await self._ws.send(self._buf)
+                self._buf = b""
+            await self._ws.send(json.dumps({"type": "Terminate"}))
+        except Exception as e:
+            print(f"Streaming STT terminate failed: {e}")
+    
+    async def results(self):
+        async for message in self._ws:
+            data = json.loads(message)
+            if data.get("type") == "Turn":
+                if not data.get("end_of_turn"):
+                    yield data.get("transcript", ""), False
+                elif data.get("turn_is_formatted"):
+                    yield data.get("transcript", ""), True
+            elif data.get("type") == "Termination":
+                return
+    
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+
+def make_streaming_recognizer() -> StreamingRecognizer:
+    if STREAMING_STT_PROVIDER == "fake":
+        return FakeStreamingRecognizer(FAKE_STT_SCRIPT)
+    return AssemblyAIStreamingRecognizer()
+
+def connect_media_stream(response: VoiceResponse, session_id: str):
+    """Hand the call's audio to /media-stream; the call ends when the socket closes."""
+    ws_url = PUBLIC_URL.replace("https://", "wss://", 1).replace("http://", "ws://", 1)
+    connect = Connect()
+    stream = connect.stream(url=f"{ws_url}/media-stream")
+    stream.parameter(name="session_id", value=session_id)
+    response.append(connect)
+    response.hangup()
+
+async def read_prompt_audio(audio_id: str):
+    """Complete bytes of a rendered prompt, waiting for it if it is still being synthesized."""
+    if prompt_pack is not None:
+        audio = prompt_pack.get(audio_id)
+        if audio is not None:
+            return audio
+    render = segment_renders.get(audio_id) or tts_flights.calls.get(audio_id)
+    if render is not None:
+        await asyncio.wait_for(asyncio.shield(render), TTS_TIMEOUT)
+    stream = active_tts_streams.get(audio_id)
+    if stream is not None:
+        audio = b"".join([chunk async for chunk in stream.iter_chunks()])
+        return None if stream.failed else audio
+    return await audio_store.read(audio_id)
+
+class MediaStreamCall:
+    """One Twilio Media Stream: caller audio goes to a recognizer, and each final segment runs a
+    turn whose reply is sent back as mu-law media on the same socket."""
+    
+    MEDIA_CHUNK_BYTES = 8000  # 1 s of 8 kHz mu-law per media message
+    
+    def __init__(self, websocket: WebSocket, stream_sid: str, call_sid: str, session_id: str):
+        self.websocket = websocket
+        self.stream_sid = stream_sid
+        self.call_sid = call_sid
+        self.session_id = session_id
+        self.recognizer = make_streaming_recognizer()
+        self.speaking = False
+        self.hangup_after_reply = False
+        self.pending_say = None
+        self._listener = None
+    
+    async def start(self):
+        await self.recognizer.start()
+        self._listener = asyncio.create_task(self._listen())
+    
+    async def send(self, message: dict):
+        message["streamSid"] = self.stream_sid
+        await self.websocket.send_text(json.dumps(message))
+    
+    async def _listen(self):
+        try:
+            async for text, is_final in self.recognizer.results():
+                if not is_final:
+                    if self.speaking and text.strip():
+                        # Caller talked over the prompt: stop playback
+                        await self.send({"event": "clear"})
+                        self.speaking = False
+                    continue
+                print(f"User said (stream): {text}")
+                await self.handle_turn(text)
+        except Exception as e:
+            print(f"Media stream listener failed: {e}")
+    
+    async def handle_turn(self, user_input: str):
+        trace = [trace_event("stream_turn", call_sid=self.call_sid)]
+        turn_trace.set(trace)
+        try:
+            await self._run_turn(user_input)
+        finally:
+            await session_mgr.record_events(self.session_id, trace)
+    
+    async def _run_turn(self, user_input: str):
+        def step(session):
+            # Label this turn's stages with the state being answered, as the webhook does
+            metrics_state.set(session.state.value)
+            return advance_conversation(session, user_input)
+        
+        session, reply = await session_mgr.transition(self.session_id, step)
+        if session is None:
+            print(f"ERROR: Session {self.session_id} not found for media stream")
+            return
+        self.hangup_after_reply = session.state in [ConversationState.REJECTED, ConversationState.COMPLETED]
+        
+        if await self.play(reply) == reply:
+            await self.fallback_say(reply)
+        else:
+            start_speculation(self.session_id, session)
+        if self.hangup_after_reply:
+            await log_interview_result(self.session_id, session)
+    
+    async def play(self, reply: str) -> str:
+        """Send the reply sentence by sentence: the first once it is rendered, each later one
+        when its own render finishes (they all render at once). Returns the text from the first sentence that did not render (the whole reply if none did)."""
+        segments = tts_segments(reply)
+        audio_urls = await generate_tts_segments(reply, self.session_id) or [None] * len(segments)
+        played = 0
+        for audio_url in audio_urls:
+            if audio_url is None:
+                break
+            audio = await read_prompt_audio(audio_url.rsplit("/", 1)[1])
+            if audio is None:
+                break
+            if TTS_AUDIO_FORMAT != "ulaw":
+                audio = await asyncio.to_thread(UlawTranscoder().feed, audio)
+            for i in range(0, len(audio), self.MEDIA_CHUNK_BYTES):
+                payload = base64.b64encode(audio[i:i + self.MEDIA_CHUNK_BYTES]).decode("ascii")
+                await self.send({"event": "media", "media": {"payload": payload}})
+            self.speaking = True
+            played += 1
+        if not played:
+            return reply
+        remainder = " ".join(segments[played:])
+        if remainder:
+            # Redirecting now would cut off the sentences already sent: <Say> the rest once they played
+            self.pending_say = remainder
+        # Twilio echoes the mark once everything before it has played
+        await self.send({"event": "mark", "mark": {"name": "fallback" if remainder else "reply"}})
+        return remainder
+    
+    async def fallback_say(self, reply: str):
+        """TTS failed: redirect the call to <Say> the reply, then reconnect a fresh stream."""
+        if not (twilio_client and self.call_sid):
+            return
+        response = VoiceResponse()
+        response.say(reply, voice="Polly.Joanna", language="en-US")
+        if self.hangup_after_reply:
+            response.hangup()
+        else:
+            connect_media_stream(response, self.session_id)
+        await asyncio.to_thread(twilio_client.calls(self.call_sid).update, twiml=str(response))
+    
+    async def on_mark(self, name: str) -> bool:
+        """True once the final reply has played and the stream should end."""
+        self.speaking = False
+        if name == "fallback" and self.pending_say:
+            reply, self.pending_say = self.pending_say, None
+            await self.fallback_say(reply)
+            return False
+        return name == "reply" and self.hangup_after_reply
+    
+    async def close(self):
+        await self.recognizer.finish()
+        if self._listener is not None:
+            try:
+                await asyncio.wait_for(self._listener, 5)
+            except Exception:
+                self._listener.cancel()
+        await self.recognizer.close()
+
+@app.websocket("/media-stream")
+async def media_stream(websocket: WebSocket):
+    """Twilio Media Streams endpoint (CALL_AUDIO_MODE=stream)."""
+    await websocket.accept()
+    call = None
+    try:
+        while True:
+            event = json.loads(await websocket.receive_text())
+            kind = event.get("event")
+            if kind == "start":
+                start = event["start"]
+                session_id = start.get("customParameters", {}).get("session_id")
+                print(f"Media stream started - Session: {session_id}, Call: {start.get('callSid')}")
+                call = MediaStreamCall(websocket, start["streamSid"], start.get("callSid"), session_id)
+                await call.start()
+            elif kind == "media" and call is not None:
+                await call.recognizer.feed(base64.b64decode(event["media"]["payload"]))
+            elif kind == "mark" and call is not None:
+                if await call.on_mark(event["mark"].get("name")):
+                    # Closing the socket lets Twilio continue to the <Hangup/> after <Connect>
+                    await websocket.close()
+                    break
+            elif kind == "stop":
+                break
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Media stream error: {e}")
+    finally:
+        if call is not None:
+            await call.close()
+
 # ================= STATIC FILES & WEB INTERFACE =================
 
 @app.get("/")
@@ -521,10 +2857,35 @@ def read_root():
     return FileResponse("index.html")
 
 @app.get("/audio/{audio_id}")
-def get_audio(audio_id: str):
-    audio_path = TEMP_AUDIO_DIR / audio_id
-    if audio_path.exists():
-        return FileResponse(audio_path, media_type="audio/wav")
+async def get_audio(audio_id: str):
+    if prompt_pack is not None:
+        audio = prompt_pack.get(audio_id)
+        if audio is not None:
+            return Response(content=audio, media_type=audio_media_type(audio_id))
+    
+    render = segment_renders.get(audio_id) or tts_flights.calls.get(audio_id)
+    if render is not None:
+        # A later sentence of a segmented reply that is still rendering
+        try:
+            await asyncio.wait_for(asyncio.shield(render), TTS_TIMEOUT)
+        except Exception as e:
+            print(f"Waiting for {audio_id} failed: {e}")
+    
+    stream = active_tts_streams.get(audio_id)
+    if stream is not None:
+        # Still synthesizing: relay chunks as they arrive (chunked transfer encoding)
+        if await stream.wait_first_chunk():
+            return StreamingResponse(stream.iter_chunks(), media_type=audio_media_type(audio_id))
+        raise HTTPException(status_code=502, detail="Audio synthesis failed")
+    
+    audio_response = await audio_store.response(audio_id)
+    if audio_response is not None:
+        return audio_response
+    if audio_id.startswith("tts_"):
+        # Prompt URLs are only handed out for renders we started: one that failed after its
+        # <Play> went out becomes a short pause, so Twilio carries on with the next sentence
+        tts_router.decisions["segment_silenced"] += 1
+        return Response(content=silence_audio(), media_type=audio_media_type(audio_id))
     raise HTTPException(status_code=404, detail="Audio not found")
 
 @app.get("/dashboard", response_class=HTMLResponse)
@@ -625,6 +2986,124 @@ def dashboard():
     </html>
     """
 
+# Whole-record layouts the session hashes are benchmarked against
+SESSION_FIELDS = ('state', 'candidate_type', 'retry_count', 'turn', 'phone_number', 'answers', 'conversation')
+
+def encode_session(data: dict, encoding: str = "msgpack") -> bytes:
+    """Session dict -> one string record: JSON, or a version byte + msgpack array of SESSION_FIELDS."""
+    if encoding == "json":
+        return json.dumps(data).encode("utf-8")
+    fields = [data.get(name) for name in SESSION_FIELDS]
+    fields[0] = STATE_CODES[data['state']]
+    return bytes([1]) + msgpack.packb(fields, use_bin_type=True)
+
+def decode_session(raw: bytes) -> dict:
+    """String record from encode_session -> session dict."""
+    if raw[:1] == b"{":
+        return json.loads(raw)
+    data = dict(zip(SESSION_FIELDS, msgpack.unpackb(raw[1:], raw=False)))
+    data['state'] = STATE_NAMES[data['state']]
+    return data
+
+def bench_session_encoding(rounds: int = 20000):
+    """Bytes written, encode/decode CPU and bytes read per turn for the last turn of an interview
+    (the festival story arrives): whole-record JSON and msgpack against the session hashes used now."""
+    story = "I helped a customer whose broadband kept dropping, stayed on the line and fixed it step by step. " * 4
+    session = SessionData(
+        phone_number='+919876543210',
+        state=ConversationState.FESTIVAL_STORY,
+        candidate_type='experienced',
+        retry_count=1,
+        answers={'experience': 'Two years in a telecom voice process', 'customer_story': story},
+        turn=7
+    )
+    session.mark_clean()
+    session.state = ConversationState.COMPLETED
+    session.answers['festival'] = story
+    session.turn += 1
+    data = session.to_dict()
+    
+    def timed(fn) -> float:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        return (time.perf_counter() - started) / rounds * 1e6
+    
+    print(f"{'encoding':<12}{'written':>8}{'save µs':>10}{'get µs':>10}{'read':>8}")
+    for encoding in ("json", "msgpack"):
+        raw = encode_session(data, encoding)
+        assert decode_session(raw) == data
+        save_us = timed(lambda: encode_session(data, encoding))
+        get_us = timed(lambda: decode_session(raw))
+        print(f"{encoding:<12}{len(raw):>8}{save_us:>10.2f}{get_us:>10.2f}{len(raw):>8}")
+    
+    # A turn reads only the control fields; the answers hash stays in Redis
+    delta = pack_session_fields(session.dirty_fields()[0])
+    control = {name: value for name, value in session.fields().items() if not name.startswith("a:")}
+    stored = {name.encode(): value for name, value in pack_session_fields(control).items()}
+    stored.update({b"_s": str(SESSION_SCHEMA_VERSION).encode(), b"_v": b"8"})
+    save_us = timed(lambda: pack_session_fields(session.dirty_fields()[0]))
+    get_us = timed(lambda: unpack_session_hash(stored))
+    written = sum(len(k) + len(v) for k, v in delta.items())
+    read = sum(len(k) + len(v) for k, v in stored.items())
+    print(f"{'hash delta':<12}{written:>8}{save_us:>10.2f}{get_us:>10.2f}{read:>8}")
+
+def check_media_stream() -> bool:
+    """Drive /media-stream in-process with scripted mu-law frames: the fake recognizer hears one
+    answer, the turn advances the session and the reply comes back as media followed by a mark.
+    CambAI is replaced by a second of silence; sessions use whatever store is configured."""
+    import io
+    import math
+    import wave
+    from fastapi.testclient import TestClient
+    global STREAMING_STT_PROVIDER, FAKE_STT_SCRIPT, TTS_CACHE_ENABLED, tts_http
+    
+    silence = io.BytesIO()
+    with wave.open(silence, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(b"\x00\x00" * 16000)
+    STREAMING_STT_PROVIDER, FAKE_STT_SCRIPT = "fake", ["yes sure"]
+    TTS_CACHE_ENABLED = False  # keep the placeholder audio out of the shared prompt cache
+    tts_http = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=silence.getvalue())))
+    
+    # 20 ms frames: 400 ms of a tone, then enough silence for the recognizer to end the segment
+    tone = struct.pack("<160h", *(int(8000 * math.sin(i / 3)) for i in range(160)))
+    frames = [audioop.lin2ulaw(tone, 2)] * 20 + [audioop.lin2ulaw(b"\x00\x00" * 160, 2)] * 40
+    
+    session_id = f"check_{uuid.uuid4().hex[:8]}"
+    with TestClient(app) as client:
+        client.portal.call(session_mgr.save, session_id, SessionData(phone_number="check", state=ConversationState.INTEREST_CHECK))
+        events = []
+        with client.websocket_connect("/media-stream") as websocket:
+            websocket.send_text(json.dumps({"event": "connected"}))
+            start = {"streamSid": "MZcheck", "callSid": None, "customParameters": {"session_id": session_id}}
+            websocket.send_text(json.dumps({"event": "start", "start": start}))
+            for frame in frames:
+                websocket.send_text(json.dumps({"event": "media", "media": {"payload": base64.b64encode(frame).decode("ascii")}}))
+            while not events or events[-1] != "mark":
+                events.append(json.loads(websocket.receive_text())["event"])
+            websocket.send_text(json.dumps({"event": "stop"}))
+        session = client.portal.call(session_mgr.get, session_id)
+        client.portal.call(audio_store.delete_session, session_id)
+        client.portal.call(session_mgr.delete, session_id)
+    
+    state = session["state"] if session else None
+    ok = state == ConversationState.EXPERIENCE_CHECK.value and events.count("media") > 0
+    print(f"{'✅' if ok else '❌'} media stream: state {state}, sent back {events}")
+    return ok
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "build-prompt-pack":
+        # python main.py build-prompt-pack [output path]
+        out_path = Path(sys.argv[2]) if len(sys.argv) > 2 else PROMPT_PACK_PATH
+        sys.exit(1 if asyncio.run(build_prompt_pack(out_path)) else 0)
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-session-encoding":
+        bench_session_encoding()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "check-media-stream":
+        sys.exit(0 if check_media_stream() else 1)
+    
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)